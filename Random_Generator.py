@@ -1,29 +1,28 @@
+import os
 import random
 
+from aux_functions import write_random_numbers
+
 
 def RandomGenerator(filename, count, seed=None):
     # Set the seed for random number generation
     if seed is not None:
         random.seed(seed)
 
-    # Set the seed for random number generation
-    if seed is not None:
-        random.seed(seed)
+    random_numbers = [random.random() for _ in range(count)]
 
     # Create and open the file in write mode
     with open(filename, 'w') as file:
-        for _ in range(count):
-            random_number = random.random()
+        for random_number in random_numbers:
             file.write(f"{random_number}\n")
 
-
-filename = "random_numbers.txt"
-seed = 42
-count = 2**20
-RandomGenerator(filename, count,seed)
-print(f"{count} Random number with seed {seed} has been exported")
-
-
-
+    # Binary float64 copy of the same numbers, read as a memory map (see read_random_numbers)
+    write_random_numbers(filename, os.path.splitext(filename)[0] + ".npy")
 
 
+if __name__ == "__main__":
+    filename = "random_numbers.txt"
+    seed = 42
+    count = 2**20
+    RandomGenerator(filename, count,seed)
+    print(f"{count} Random number with seed {seed} has been exported")
@@ -1,18 +1,39 @@
 ''' Reviewed by Angel A. Juan 2023.06 for the TOP with stochastic / dynamic travel times '''
 
+import ast
+import csv
+import os
+import tempfile
+import numpy as np
+
 from aux_objects import Test, Node
 
-""" Generate a list of tests to run from a file """
+""" Generate a list of tests to run from a file. After the 8 columns of a test, optional
+    name=value columns set other attributes of the test (e.g., racing=True or simEngine=loop) """
 def read_tests(file_name):
     with open(file_name) as file:
         tests = []
         for line in file:
             tokens = line.split("\t")
             if '#' not in tokens[0]:
-                aTest = Test(*tokens) # '*' unpacks tokens as parameters
+                options = [token.strip() for token in tokens[8:] if token.strip() != ""]
+                aTest = Test(*tokens[:8]) # '*' unpacks tokens as parameters
+                for option in options:
+                    set_test_option(aTest, option)
                 tests.append(aTest)
     return tests
 
+""" Set an attribute of a test from a name=value column of a tests file """
+def set_test_option(test, option):
+    name, _, value = option.partition("=")
+    if not hasattr(test, name):
+        raise ValueError("Unknown test option: " + option)
+    try:
+        value = ast.literal_eval(value) # numbers, True / False, None, quoted strings
+    except (ValueError, SyntaxError):
+        pass # unquoted string, e.g. simEngine=loop
+    setattr(test, name, value)
+
 """ Generate a list of nodes from instance file """
 def read_instance(file_name):
     with open(file_name) as instance:
@@ -31,6 +52,33 @@ def read_instance(file_name):
             i += 1
     return fleetSize, routeMaxCost, nodes
 
+""" Read the random numbers used by the BR. The binary copy of the text file (.npy, written by
+    Random_Generator.py) is opened as a read-only memory map, which is loaded only once and shared
+    by all the processes. If the copy is missing or older than the text file (e.g., the text file
+    was written again by the Julia port), it is first rebuilt from the text file """
+def read_random_numbers(file_name = "random_numbers.txt"):
+    binary_name = os.path.splitext(file_name)[0] + ".npy"
+    if os.path.exists(file_name) and (not os.path.exists(binary_name) or
+            os.path.getmtime(binary_name) < os.path.getmtime(file_name)):
+        write_random_numbers(file_name, binary_name)
+    return np.load(binary_name, mmap_mode = "r")
+
+""" Write the binary copy of a text file of random numbers (bit-identical, since the text file
+    holds the shortest repr of each number, which float() reads back exactly) """
+def write_random_numbers(file_name, binary_name):
+    with open(file_name, "r") as random_file:
+        random_numbers = np.array([float(line.strip()) for line in random_file], dtype = np.float64)
+    # a temp file of its own, in case other processes rebuild it too: the memory maps always
+    # see either the old file or a complete new one
+    temp_fd, temp_name = tempfile.mkstemp(suffix = ".npy", dir = os.path.dirname(os.path.abspath(binary_name)))
+    try:
+        with os.fdopen(temp_fd, "wb") as temp_file:
+            np.save(temp_file, random_numbers)
+        os.replace(temp_name, binary_name)
+    except BaseException:
+        os.remove(temp_name)
+        raise
+
 """ Print routes in a solution """
 def printRoutes(sol):
     for route in sol.routes:
@@ -39,3 +87,58 @@ def printRoutes(sol):
             print("->", e.end.ID, end="")
         print("\nRoute det reward:", route.reward, "; det cost:", route.cost)
     print("Solution time: ", sol.time)
+
+""" Key of a test in a results file: tests with the same key give the same row """
+def get_test_key(test):
+    return (test.instanceName, str(test.seed), str(test.varLevel), str(test.maxTime))
+
+""" Key of a row of a results file (None if the row has no key fields) """
+def get_result_key(row):
+    key = (row.get("Instance"), row.get("Seed"), row.get("VarLevel"), row.get("MaxTime"))
+    return None if None in key else key
+
+""" Read the complete rows of a results file (a row cut by a crash is discarded) """
+def read_results(file_name):
+    with open(file_name, newline = '') as csvfile:
+        lines = csvfile.read().splitlines(keepends = True)
+    if len(lines) > 0 and not lines[-1].endswith("\n"):
+        lines.pop() # the last row was being written when the process died
+    return list(csv.DictReader(lines))
+
+""" Write the header and the rows of a results file to a temporary file that atomically
+    replaces the old one, so the file is never left half written """
+def checkpoint_results(file_name, fieldnames, rows):
+    temp_name = file_name + ".tmp"
+    with open(temp_name, 'w', newline = '') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames = fieldnames, restval = '', extrasaction = 'ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+        csvfile.flush()
+        os.fsync(csvfile.fileno())
+    os.replace(temp_name, file_name)
+
+""" Open a results file to append rows one at a time. The header and, if resume, the complete
+    rows already in the file are first checkpointed. Returns the file, its writer and the
+    checkpointed rows """
+def open_results(file_name, fieldnames, resume = False):
+    rows = read_results(file_name) if resume and os.path.exists(file_name) else []
+    checkpoint_results(file_name, fieldnames, rows)
+    csvfile = open(file_name, 'a', newline = '')
+    writer = csv.DictWriter(csvfile, fieldnames = fieldnames, restval = '', extrasaction = 'ignore')
+    return csvfile, writer, rows
+
+""" Sort the rows of a results file in the order of the tests (rows appended as the tests
+    finish are not in that order). Rows of other tests go first, in their current order """
+def sort_results(file_name, fieldnames, tests):
+    position = {}
+    for i, test in enumerate(tests):
+        position.setdefault(get_test_key(test), i)
+    rows = read_results(file_name)
+    rows.sort(key = lambda row: position.get(get_result_key(row), -1))
+    checkpoint_results(file_name, fieldnames, rows)
+
+""" Append a row to a results file and flush it to disk """
+def write_result(csvfile, writer, row):
+    writer.writerow(row)
+    csvfile.flush()
+    os.fsync(csvfile.fileno())
@@ -1,7 +1,18 @@
 ''' Reviewed by Angel A. Juan 2023.06 for the TOP with stochastic / dynamic travel times '''
 
+import copy
+import collections
+import numpy as np
+from multiprocessing import shared_memory
+
+from travel_models import loadTravelModel
+
 ''' A class defining Test objects '''
 class Test:
+    # The optional heuristics below (racing, stage2Budget, prescreenLevel, surrogate) are off by
+    # default, so the defaults run the baseline algorithm: shortSim runs for every promising
+    # candidate and longSim runs for each of the (up to) 10 elite sols. Any attribute can be
+    # set from a tests file with an extra name=value column (see read_tests), e.g. racing=True
 
     def __init__(self, instanceName, maxTime, firstParam, secondParam, seed, shortSim, longSim, varLevel):
         self.instanceName = instanceName
@@ -14,10 +25,28 @@ class Test:
         self.varLevel = float(varLevel) # Var[X] = varLevel * E[X]
 
         self.index1 = 0
+        self.simStats = {} # counters of the last simExcecution (see simheu.getSimStats)
+        self.nWorkers = 1 # processes running merging processes in parallel (1 = serial search)
+        self.chunkSize = 20 # merging processes per work unit of a worker
+        self.simEngine = "vectorized" # Monte Carlo engine: "vectorized", "loop" (one run at a time) or "importance"
+        self.routeCacheSize = 10000 # max routes in each route simulation cache (0 = no cache)
+        self.useCRN = True # evaluate all sols against the same scenario bank (common random numbers)
+        self.racing = False # simulate candidates in blocks of runs until they clearly lose or win
+        self.raceBlock = 20 # number of runs per block when racing
+        self.edgeTypes = "dynamic" # edge types: "dynamic" (as setEdgesType), "mixed" (as setEdgesType1) or "det"
+        self.travelModel = None # file of a fitted travel-time model for dynamic edges (None = getDynamicValue)
+        self.travelBins = 16 # weather / traffic bins of the travel-time prediction cache (0 = no cache)
+        self.sampler = "random" # scenario bank sampler: "random", "lhs" or "vdc"
+        self.prescreenLevel = 0 # candidates with an analytic reward below this share of the best one's are not simulated (0 = off)
+        self.surrogate = False # do not simulate candidates whose predicted reward_sim is clearly below the best one's
+        self.surrogateZ = 2.0 # upper bound of a surrogate prediction = mean + surrogateZ * std. dev.
+        self.stage2Budget = 0 # total runs shared by the elite sols in stage 2 (0 = longSim runs each)
 
 ''' A class defining Node objects '''
 class Node:
 
+    __slots__ = ("ID", "x", "y", "reward", "inRoute", "dnEdge", "ndEdge", "isLinkedToStart", "isLinkedToFinish")
+
     def __init__(self, ID, x, y, reward):
         self.ID = ID # node identifier (start = nodes[0]; finish = nodes[-1])
         self.x = x # Euclidean x-coordinate
@@ -27,11 +56,13 @@ class Node:
         self.dnEdge = None # arc from start depot to this node
         self.ndEdge = None # arc from this node to finish depot
         self.isLinkedToStart = False # linked to start depot?
-        self.isLindedToFinish = False # linked to finish depot?
+        self.isLinkedToFinish = False # linked to finish depot?
 
 ''' A class defining Edge objects '''
 class Edge:
 
+    __slots__ = ("origin", "end", "cost", "savings", "invEdge", "efficiency", "type", "index")
+
     def __init__(self, origin, end):
         self.origin = origin # origin node of the edge (arc)
         self.end = end # end node of the edge (arc)
@@ -40,14 +71,36 @@ class Edge:
         self.invEdge = None # inverse edge (arc)
         self.efficiency = 0.0 # edge efficiency (enriched savings)
         self.type = 0 # 0 = deterministic (default), 1 = stoch, 2 = dynamic
+        self.index = None # position in the instance edge list (None for depot edges)
 
 ''' A class defining Route objects '''
 class Route:
 
-    def __init__(self):
+    __slots__ = ("cost", "reward", "first", "last", "links", "_edges")
+
+    def __init__(self, first = None, links = None):
          self.cost = 0.0 # cost of this route
-         self.edges = [] # sorted edges in this route
          self.reward = 0.0 # total reward collected in this route
+         self.first = first # first node after the start depot
+         self.last = first # last node before the finish depot
+         self.links = links # links[node.ID] = edge leaving node in its route (shared by all routes)
+         self._edges = None if links is not None else [] # materialized from links when needed
+
+    @property
+    def edges(self): # sorted edges in this route
+        if self._edges is None:
+            self._edges = [self.first.dnEdge]
+            node = self.first
+            while node is not self.last:
+                edge = self.links[node.ID]
+                self._edges.append(edge)
+                node = edge.end
+            self._edges.append(self.last.ndEdge)
+        return self._edges
+
+    @edges.setter
+    def edges(self, edges):
+        self._edges = edges
 
     def reverse(self): # e.g. 0 -> 2 -> 6 -> 0 becomes 0 -> 6 -> 2 -> 0
         size = len(self.edges)
@@ -60,6 +113,8 @@ class Route:
 ''' A class defining Solution objects '''
 class Solution:
 
+    __slots__ = ("ID", "routes", "cost", "reward", "reward_sim", "reward_approx", "reward_se", "nRuns_sim", "confidence", "time")
+
     last_ID = -1
     def __init__(self):
         Solution.last_ID += 1
@@ -68,4 +123,364 @@ class Solution:
         self.cost = 0.0 # cost of this solution
         self.reward = 0.0 # sol reward under deterministic conditions
         self.reward_sim = 0.0 # sol reward after simulation (stoch/dynamic conditions)
+        self.reward_approx = None # analytic approx. of reward_sim (pre-screen), if computed
+        self.reward_se = 0.0 # standard error of reward_sim
+        self.nRuns_sim = 0 # number of runs behind reward_sim
+        self.confidence = 1.0 # estimated probability that this is the best among the compared sols
         self.time = 0.0
+
+''' A class defining Instance objects (data precomputed once per instance) '''
+class Instance:
+
+    SHARED = ("coords", "rewards", "dist", "savings", "rewardSum", "edgeOrigin", "edgeEnd",
+        "edgeCost", "edgeSavings", "edgeReward", "edgeInverse") # arrays built once, see getArrays
+
+    def __init__(self, nodes, arrays = None):
+        self.nodes = nodes # start = nodes[0]; finish = nodes[-1]
+        self.nNodes = len(nodes)
+        self.edgeViews = {} # Edge objects built on demand, e.g. for the routes of a solution
+        self.costModels = {} # (varLevel, edgeTypes, travel model file, bins) -> CostModel
+        if arrays is not None: # e.g. views of shared memory built by another process
+            for name in Instance.SHARED:
+                setattr(self, name, arrays[name])
+            self.dnCost = self.dist[0, :]
+            self.ndCost = self.dist[:, -1]
+            self.nEdges = len(self.edgeOrigin)
+            self.buildDepotEdges()
+            return
+        self.coords = np.array([[node.x, node.y] for node in nodes]) # (x, y) of each node
+        self.rewards = np.array([node.reward for node in nodes]) # reward of each node
+        # full matrix of Euclidean distances, dist[i, j] = cost of arc (i, j)
+        dx = self.coords[None, :, 0] - self.coords[:, None, 0]
+        dy = self.coords[None, :, 1] - self.coords[:, None, 1]
+        self.dist = np.sqrt(dx**2 + dy**2)
+        self.dnCost = self.dist[0, :] # cost of arc (start, node)
+        self.ndCost = self.dist[:, -1] # cost of arc (node, finish)
+        # savings and reward sum of each arc (i, j), as in Panadero et al.(2020)
+        self.savings = self.ndCost[:, None] + self.dnCost[None, :] - self.dist
+        self.rewardSum = self.rewards[:, None] + self.rewards[None, :]
+        # arcs between customers, listed as (i, j), (j, i) pairs for i < j
+        iIDs, jIDs = np.triu_indices(self.nNodes - 2, 1)
+        iIDs, jIDs = iIDs + 1, jIDs + 1 # excludes the start depot
+        self.edgeOrigin = np.stack([iIDs, jIDs], axis = 1).ravel()
+        self.edgeEnd = np.stack([jIDs, iIDs], axis = 1).ravel()
+        self.edgeCost = self.dist[self.edgeOrigin, self.edgeEnd]
+        self.edgeSavings = self.savings[self.edgeOrigin, self.edgeEnd]
+        self.edgeReward = self.rewardSum[self.edgeOrigin, self.edgeEnd]
+        self.edgeInverse = np.arange(len(self.edgeOrigin)) ^ 1 # index of the inverse edge (arc)
+        self.nEdges = len(self.edgeOrigin)
+        self.buildDepotEdges()
+
+    def getArrays(self): # arrays that describe the instance (together with its nodes)
+        return {name: getattr(self, name) for name in Instance.SHARED}
+
+    def buildDepotEdges(self): # builds the (start, node) and (node, finish) edges (arcs)
+        start = self.nodes[0]
+        finish = self.nodes[-1]
+        dnCost = self.dnCost.tolist()
+        ndCost = self.ndCost.tolist()
+        for node in self.nodes[1:-1]: # excludes the start and finish depots
+            node.dnEdge = Edge(start, node) # (start, node) edge (arc)
+            node.dnEdge.cost = dnCost[node.ID]
+            node.ndEdge = Edge(node, finish) # (node, finish) edge (arc)
+            node.ndEdge.cost = ndCost[node.ID]
+
+    def getCostModel(self, varLevel, edgeTypes = "dynamic", travelModelFile = None, travelBins = 0):
+        key = (varLevel, edgeTypes, travelModelFile, travelBins) # each model is built once
+        if key not in self.costModels:
+            travelModel = None
+            if travelModelFile is not None:
+                travelModel = loadTravelModel(travelModelFile, travelBins)
+            self.costModels[key] = CostModel(self, varLevel, edgeTypes, travelModel)
+        return self.costModels[key]
+
+    def getEdge(self, k): # Edge object (with its inverse edge) for the k-th customer edge
+        if k not in self.edgeViews:
+            edge, invEdge = Edge(None, None), Edge(None, None)
+            for e, index in ((edge, k), (invEdge, k ^ 1)):
+                e.origin = self.nodes[self.edgeOrigin[index]]
+                e.end = self.nodes[self.edgeEnd[index]]
+                e.cost = float(self.edgeCost[index])
+                e.savings = float(self.edgeSavings[index])
+                e.index = index
+                self.edgeViews[index] = e
+            edge.invEdge = invEdge
+            invEdge.invEdge = edge
+        return self.edgeViews[k]
+
+''' A class defining CostModel objects (parameters of the random cost of each edge of an instance) '''
+class CostModel:
+    # Arrays indexed by (origin ID, end ID), so that simulations only read them: type of each
+    # edge (0 = det, 1 = stoch, 2 = dynamic), lognormal parameters of stochastic costs with
+    # Var[X] = varLevel * E[X], and weather / traffic coefficients of dynamic costs (these are
+    # not used if a travel-time model, see travel_models.py, predicts the dynamic costs)
+
+    def __init__(self, instance, varLevel, edgeTypes = "dynamic", travelModel = None):
+        self.varLevel = varLevel
+        self.edgeTypes = edgeTypes
+        self.travelModel = travelModel
+        self.coords = instance.coords # edge features of travel-time models
+        endIDs = np.arange(instance.nNodes)
+        if edgeTypes == "dynamic": # dynamic if the ID of the end node is even (setEdgesType)
+            endType = np.where(endIDs % 2 == 0, 2, 0)
+        elif edgeTypes == "mixed": # stoch if even, else dynamic if divisible by 3 (setEdgesType1)
+            endType = np.where(endIDs % 2 == 0, 1, np.where(endIDs % 3 == 0, 2, 0))
+        elif edgeTypes == "det":
+            endType = np.zeros(instance.nNodes, dtype = int)
+        else:
+            raise ValueError("Unknown edge types: " + str(edgeTypes))
+        self.type = np.tile(endType, (instance.nNodes, 1)) # the type only depends on the end node
+        cost = instance.dist
+        positive = cost > 0 # null costs stay null
+        safeCost = np.where(positive, cost, 1.0)
+        var = varLevel * safeCost
+        self.mu = np.where(positive, np.log(safeCost**2 / np.sqrt(var + safeCost**2)), -np.inf)
+        self.sigma = np.where(positive, np.sqrt(np.log(1 + var / safeCost**2)), 0.0)
+        self.b_w = 0.2 * cost * 0.25 # coefficient for weather conditions
+        self.b_t = 0.3 * cost * 0.25 # coefficient for traffic conditions
+
+''' A class defining SharedArrays objects (numpy arrays in named shared-memory segments) '''
+class SharedArrays:
+    # The creator copies each array once into its own segment, and other processes attach to
+    # the segments by name (spec) and get views of them, without copies. The creator has to
+    # call close(unlink = True) when no process needs the segments anymore
+
+    def __init__(self, arrays = None, spec = None):
+        self.segments = []
+        self.arrays = {} # name -> array (view of a segment)
+        if arrays is not None: # creates the segments
+            spec = {}
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                segment = shared_memory.SharedMemory(create = True, size = max(array.nbytes, 1))
+                self.arrays[name] = np.ndarray(array.shape, array.dtype, buffer = segment.buf)
+                self.arrays[name][...] = array
+                self.segments.append(segment)
+                spec[name] = (segment.name, array.shape, array.dtype.str)
+        else: # attaches to the segments of spec
+            for name, (segmentName, shape, dtype) in spec.items():
+                segment = shared_memory.SharedMemory(name = segmentName)
+                self.arrays[name] = np.ndarray(shape, dtype, buffer = segment.buf)
+                self.segments.append(segment)
+        self.spec = spec # name -> (segment name, shape, dtype), to attach from other processes
+
+    def close(self, unlink = False):
+        self.arrays = {} # views have to be released before closing the segments
+        for segment in self.segments:
+            segment.close()
+            if unlink:
+                segment.unlink()
+        self.segments = []
+
+''' A class defining EfficiencyList objects (instance edge indices sorted by efficiency) '''
+class EfficiencyList:
+    # Removed positions are kept as tombstones: nextAlive[p] points to a position >= p
+    # that may still be alive (path halving keeps the chains short), so popping the
+    # k-th remaining edge costs O(k) amortized hops and removing a given edge is O(1).
+    # Since BR positions follow a Geometric(beta), k is small on average.
+
+    def __init__(self, order, rank = None):
+        self.order = memoryview(order) # edge indices from higher to lower efficiency
+        if rank is None:
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+        self.rank = memoryview(rank) # position of each edge index in order
+        self.allAlive = list(range(len(order) + 1)) # nextAlive of a full list
+        self.nextAlive = list(self.allAlive) # last entry is a sentinel
+        self.head = 0 # no remaining position lies before head
+        self.size = len(order) # number of remaining edges
+
+    def copy(self): # a full list sharing the order and rank of this one
+        effList = copy.copy(self)
+        effList.nextAlive = list(self.allAlive)
+        effList.reset()
+        return effList
+
+    def reset(self): # restores the full list in place, without allocating
+        self.nextAlive[:] = self.allAlive
+        self.head = 0
+        self.size = len(self.order)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, k):
+        position = self.rank[k]
+        return self.nextAlive[position] == position
+
+    def pop(self, k): # removes and returns the index of the k-th remaining edge
+        nextAlive = self.nextAlive
+        position = self.head
+        while True:
+            while nextAlive[position] != position: # skip removed positions
+                nextAlive[position] = nextAlive[nextAlive[position]]
+                position = nextAlive[position]
+            if k == 0: break
+            k -= 1
+            position += 1
+        nextAlive[position] = position + 1
+        if position == self.head:
+            self.head = position + 1
+        self.size -= 1
+        return self.order[position]
+
+    def remove(self, k): # removes the edge with index k
+        position = self.rank[k]
+        if self.nextAlive[position] != position:
+            raise ValueError("edge not in efficiency list")
+        self.nextAlive[position] = position + 1
+        self.size -= 1
+
+''' A class defining MergingWorkspace objects (preallocated state of the merging process) '''
+class MergingWorkspace:
+    # Routes are identified by their first node ID, which never changes during merging,
+    # and all route data live in lists indexed by node ID that are reset in O(n)
+
+    def __init__(self, instance, routeMaxCost):
+        self.instance = instance
+        self.routeIDs = range(1, instance.nNodes - 1) # excludes the start and finish depots
+        self.dnCost = instance.dnCost.tolist()
+        self.ndCost = instance.ndCost.tolist()
+        # compact views of the instance edge arrays (indexing returns Python scalars)
+        self.edgeOrigin = memoryview(instance.edgeOrigin)
+        self.edgeEnd = memoryview(instance.edgeEnd)
+        self.edgeCost = memoryview(instance.edgeCost)
+        self.edgeSavings = memoryview(instance.edgeSavings)
+        # dummy solution: one route (start, node, finish) per node
+        self.dummyCost = [0.0] * instance.nNodes
+        self.dummyInSol = [False] * instance.nNodes
+        self.dummySolCost = 0.0
+        self.dummySolReward = 0.0
+        for ID in self.routeIDs:
+            self.dummyCost[ID] = 0.0 + self.dnCost[ID] + self.ndCost[ID]
+            if self.dummyCost[ID] <= routeMaxCost:
+                self.dummyInSol[ID] = True
+                self.dummySolCost += self.dummyCost[ID]
+                self.dummySolReward += instance.nodes[ID].reward
+        self.dummyLast = list(range(instance.nNodes))
+        self.dummyFirst = [True] * instance.nNodes
+        self.noLinks = [None] * instance.nNodes
+        # current state, reset to the dummy solution before each merging process
+        self.routeCost = list(self.dummyCost) # cost of the route starting at each node
+        self.routeReward = [node.reward for node in instance.nodes] # reward of that route
+        self.dummyReward = list(self.routeReward)
+        self.routeLast = list(self.dummyLast) # last node of that route
+        self.inSol = list(self.dummyInSol) # is that route in the emerging solution?
+        self.isFirst = list(self.dummyFirst) # is node the first one of its route?
+        self.lastOf = list(self.dummyLast) # route ending at node, or None
+        self.links = list(self.noLinks) # index of the edge leaving node in its route
+        self.solCost = self.dummySolCost
+        self.solReward = self.dummySolReward
+        self.effList = None # efficiency list being consumed
+        self.solRoutes = [] # IDs of the routes kept in the final solution
+
+    def reset(self, eff_list):
+        self.routeCost[:] = self.dummyCost
+        self.routeReward[:] = self.dummyReward
+        self.routeLast[:] = self.dummyLast
+        self.inSol[:] = self.dummyInSol
+        self.isFirst[:] = self.dummyFirst
+        self.lastOf[:] = self.dummyLast
+        self.links[:] = self.noLinks
+        self.solCost = self.dummySolCost
+        self.solReward = self.dummySolReward
+        if self.effList is None or self.effList.order is not eff_list.order:
+            self.effList = eff_list.copy()
+        else:
+            self.effList.reset()
+
+''' A class defining SimLayout objects (edges of some routes laid out for vectorized simulation) '''
+class SimLayout:
+
+    def __init__(self):
+        self.keys = None # (origin ID, end ID) of each distinct edge
+        self.cost = None # expected cost of each distinct edge
+        self.stoch = None # columns of the edges with a stochastic travel time
+        self.dyn = None # columns of the edges with a dynamic travel time
+        self.mu = None # lognormal parameters of the stochastic edges
+        self.sigma = None
+        self.b_w = None # weather and traffic coefficients of the dynamic edges
+        self.b_t = None
+        self.travelModel = None # travel-time model of the dynamic edges, if any
+        self.dynKeys = None # (origin ID, end ID) and features of the dynamic edges, for the model
+        self.dynFeatures = None
+        self.edgeColumn = None # column of each edge of each route, route after route
+        self.routeStarts = None # position of the first edge of each route
+        self.routeRewards = None # deterministic reward of each route
+
+''' A class defining RouteSim objects (simulation results of a route) '''
+class RouteSim:
+
+    __slots__ = ("ok", "reward", "nDone")
+
+    def __init__(self, nRuns, reward):
+        self.ok = np.zeros(nRuns, dtype = bool) # route cost within routeMaxCost in each run?
+        self.reward = reward # deterministic reward of the route
+        self.nDone = 0 # runs simulated so far (the first nDone entries of ok are valid)
+
+''' A class defining RouteCache objects (bounded LRU cache of simulated routes) '''
+class RouteCache:
+    # Routes are simulated under a fixed vector of weather values (one per run), so the
+    # results of the routes of a sol can be combined run by run under shared weather.
+    # A route may be simulated for its first runs only and extended later on demand
+
+    def __init__(self, nRuns, capacity, bank = None, rng = None):
+        self.nRuns = nRuns # number of runs (weather scenarios)
+        self.capacity = capacity # max number of routes kept
+        self.rng = rng # np.random.Generator of the runs not read from the bank (None = global numpy RNG)
+        if bank is None:
+            self.weather = (rng if rng is not None else np.random).random(nRuns) # daily weather adversity level of each run
+        else: # the first nRuns scenarios of the bank
+            self.weather = bank.weather[:nRuns]
+        self.routes = collections.OrderedDict() # signature -> RouteSim
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.routes:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.routes.move_to_end(key) # most recently used
+        return self.routes[key]
+
+    def put(self, key, routeSim):
+        self.routes[key] = routeSim
+        self.routes.move_to_end(key)
+        if len(self.routes) > self.capacity:
+            self.routes.popitem(last=False) # evict the least recently used route
+
+''' A class defining ScenarioBank objects (common random numbers for all simulated sols) '''
+class ScenarioBank:
+    # Each run has a weather value, and each edge (arc) a traffic value and a standard
+    # normal value (for lognormal costs) per run. Edge columns are generated the first time
+    # the edge is simulated, from a stream that only depends on the seed, the stage and the
+    # edge, so the scenarios do not depend on which sols are simulated first
+
+    def __init__(self, nRuns, seed, sample = None, stage = 1):
+        self.nRuns = nRuns # number of runs (scenarios)
+        self.seed = seed
+        self.stage = stage # each stage of the algorithm has its own scenarios
+        self.sample = sample # sample(rng, nRuns, dim) of a stratified / QMC sampler (None = pseudo-random)
+        self.weather = self.getColumn(np.random.default_rng([seed, stage, 0]), 0) # weather level of each run
+        self.traffic = {} # (origin ID, end ID) -> traffic level of the edge in each run
+        self.normal = {} # (origin ID, end ID) -> standard normal value of the edge in each run
+
+    def getColumn(self, rng, dim): # dim: 0 = weather, 1 = traffic, 2 = standard normal
+        if self.sample is not None:
+            return self.sample(rng, self.nRuns, dim)
+        if dim == 2:
+            return rng.standard_normal(self.nRuns)
+        return rng.random(self.nRuns)
+
+    def getTraffic(self, keys, first, nBlock): # shape (nBlock, len(keys))
+        for key in keys:
+            if key not in self.traffic:
+                self.traffic[key] = self.getColumn(np.random.default_rng([self.seed, self.stage, 1, *key]), 1)
+        return np.stack([self.traffic[key][first:first + nBlock] for key in keys], axis = 1)
+
+    def getNormal(self, keys, first, nBlock): # shape (nBlock, len(keys))
+        for key in keys:
+            if key not in self.normal:
+                self.normal[key] = self.getColumn(np.random.default_rng([self.seed, self.stage, 2, *key]), 2)
+        return np.stack([self.normal[key][first:first + nBlock] for key in keys], axis = 1)
@@ -1,73 +1,93 @@
 ''' Reviewed by Angel A. Juan 2023.06 for the TOP with stochastic / dynamic travel times '''
 
 import time
-import copy
 import math
+import zlib
 import random
-import operator
+import collections
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
-from aux_objects import Edge, Route, Solution
-from simulation import simulation
+from aux_objects import Node, Route, Solution, Instance, EfficiencyList, MergingWorkspace, RouteCache, \
+    ScenarioBank, SharedArrays
+from surrogate import RewardSurrogate
+from simulation import simulation, simulateMany, simulateCached, raceSimulation, ocbaSimulation, \
+    getSampler, approxSimulation, getRouteSignature
+
+SEARCH_STAGE, FINAL_STAGE = 1, 2 # stage 1 searches for promising sols, stage 2 refines the elite ones
 
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
         MAIN SIMHEURISTIC ALGORITHM BASED ON THE PJ'S HEURISTIC
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 
-def detExcecution(test, fleetSize, routeMaxCost, nodes, random_numbers):
+def detExcecution(test, fleetSize, routeMaxCost, instance, random_numbers):
     # select the best alpha value and efficiency list for computing enchanced savings
     # and generate an initial solution using the selected alpha value and efficiency list
-    init_sol, eff_list = genInitSol(test, fleetSize, routeMaxCost, nodes, random_numbers)
+    workspace = MergingWorkspace(instance, routeMaxCost) # reused by every merging process
+    init_sol, eff_list = genInitSol(test, fleetSize, routeMaxCost, workspace, random_numbers)
     # set initial sol as Our Best Det sol in a Det environment
     OBD = init_sol
 
     # stage 1: start the main loop searching for better det sols
-    elapsed = 0
     start_time = time.time()
-    while elapsed < test.maxTime:
-        # use the merging process of the PJs heuristic to generate a new det sol
-        new_detSol = merging(True, test, fleetSize, routeMaxCost, nodes, eff_list, random_numbers)
-        # if new_detSol is promising, update best det and stoch sols if appropriate
+    # use the merging process of the PJs heuristic to generate new det sols better than OBD
+    for new_detSol in searchSols(test, fleetSize, routeMaxCost, workspace, eff_list, random_numbers,
+            lambda: OBD.reward, start_time):
+        # if new det sol is promising, update best det and stoch sols if appropriate
         if new_detSol.reward > OBD.reward:
 
             OBD = new_detSol
             OBD.time = time.time() -  start_time
-        elapsed = time.time() - start_time
 
     # stage 2: refinement of the best k stoch sols
-    simulation(OBD, test.longSim, routeMaxCost, test.varLevel) # guarantee that the OBD keeps an acurate estimate
+    bank = getScenarioBank(test, FINAL_STAGE) # same scenarios as the elite sols of simExcecution
+    costModel = instance.getCostModel(test.varLevel, test.edgeTypes, test.travelModel, test.travelBins)
+    simulateSols(test, [OBD], test.longSim, routeMaxCost, bank = bank, costModel = costModel,
+        stage = FINAL_STAGE) # guarantee that the OBD keeps an acurate estimate
 
     return OBD
 
 
-def simExcecution(test, fleetSize, routeMaxCost, nodes, random_numbers):
+def simExcecution(test, fleetSize, routeMaxCost, instance, random_numbers):
     # select the best alpha value and efficiency list for computing enchanced savings
     # and generate an initial solution using the selected alpha value and efficiency list
-    init_sol, eff_list = genInitSol(test, fleetSize, routeMaxCost, nodes, random_numbers)
+    workspace = MergingWorkspace(instance, routeMaxCost) # reused by every merging process
+    init_sol, eff_list = genInitSol(test, fleetSize, routeMaxCost, workspace, random_numbers)
     # set initial sol as Our Best Det sol in a Det environment
     OBD = init_sol
-    simulation(OBD, test.shortSim, routeMaxCost, test.varLevel)
+    # scenarios shared by all simulated sols, and route-level cache of simulation results
+    bank = getScenarioBank(test)
+    cache = getRouteCache(test, fleetSize, bank)
+    costModel = instance.getCostModel(test.varLevel, test.edgeTypes, test.travelModel, test.travelBins) # read by every simulation
+    simulateSols(test, [OBD], test.shortSim, routeMaxCost, cache, bank, costModel)
+    # online model of reward_sim, trained with every simulated sol
+    surrogate = RewardSurrogate(routeMaxCost, costModel, test.surrogateZ) if test.surrogate == True else None
+    if surrogate is not None:
+        surrogate.update(OBD)
     list_OBS = []
     list_OBS.append(OBD)
     OBS = OBD
+    nSimulated = 0 # candidates simulated in stage 1
 
     # stage 1: start the main loop searching for better det and stoch sols
-    elapsed = 0
     start_time = time.time()
 
-    while elapsed < test.maxTime:
-        # use the merging process of the PJs heuristic to generate a new det sol
-        new_detSol = merging(True, test, fleetSize, routeMaxCost, nodes, eff_list, random_numbers)
+    # use the merging process of the PJs heuristic to generate new det sols better than OBS
+    for new_detSol in searchSols(test, fleetSize, routeMaxCost, workspace, eff_list, random_numbers,
+            lambda: OBS.reward, start_time, keepAll = True):
         # if new_detSol is promising, update best det and stoch sols if appropriate
         if new_detSol.reward > OBS.reward:
-            simulation(new_detSol, test.shortSim, routeMaxCost, test.varLevel)
-
-            if new_detSol.reward_sim > OBS.reward_sim:
-                OBS = new_detSol
-                OBS.time = time.time() - start_time
-
-                list_OBS.append(OBS)
-        elapsed = time.time() - start_time
+            if (surrogate is None or not surrogate.isUnpromising(new_detSol, OBS)) and \
+                    not isHopeless(test, new_detSol, OBS, routeMaxCost, costModel):
+                isBetter = isBetterSim(test, new_detSol, OBS, test.shortSim, routeMaxCost, cache, bank, costModel)
+                nSimulated += 1
+                if surrogate is not None:
+                    surrogate.update(new_detSol)
+                if isBetter:
+                    OBS = new_detSol
+                    OBS.time = time.time() - start_time
+
+                    list_OBS.append(OBS)
 
     # stage 2: refinement of the best k stoch sols
     list_OBS.sort(key=lambda sol: sol.reward_sim, reverse=True)
@@ -75,56 +95,214 @@ def simExcecution(test, fleetSize, routeMaxCost, nodes, random_numbers):
 
     max_elite = 10  # max number of elite sols to consider
     k = min(max_elite, len(list_OBS))  # number of elite stochastic solutions to consider
+    test.simStats = getSimStats(cache, surrogate, nSimulated)
+    # the elite sols are estimated again on new scenarios: the stage 1 runs selected them, so
+    # extending those runs would bias their reward_sim upwards
+    bank = getScenarioBank(test, FINAL_STAGE)
+    cache = getRouteCache(test, fleetSize, bank, FINAL_STAGE)
+    if test.stage2Budget > 0 and cache is not None: # spend the run budget where the ranking is uncertain
+        OBS = ocbaSimulation(list_OBS[0:k], test.stage2Budget, cache, routeMaxCost, test.varLevel,
+            test.raceBlock, bank = bank, costModel = costModel)
+        simulateSols(test, [OBS], test.longSim, routeMaxCost, cache, bank, costModel,
+            FINAL_STAGE) # accurate estimate of the winner
+        return OBS
+    if test.racing == True and cache is not None: # race each elite sol against the best one so far
+        for i in range(0, k):
+            new_OBS = list_OBS[i]
+            if new_OBS is not OBS and isBetterSim(test, new_OBS, OBS, test.longSim, routeMaxCost, cache, bank, costModel):
+                OBS = new_OBS
+        simulateSols(test, [OBS], test.longSim, routeMaxCost, cache, bank, costModel,
+            FINAL_STAGE) # accurate estimate of the winner
+        return OBS
+    simulateSols(test, list_OBS[0:k], test.longSim, routeMaxCost, cache, bank, costModel,
+        FINAL_STAGE) # all elite sols at once
     for i in range(0, k):
         new_OBS = list_OBS[i]
-        simulation(new_OBS, test.longSim, routeMaxCost, test.varLevel)
         if new_OBS.reward_sim > OBS.reward_sim:
             OBS = new_OBS
 
     return OBS
 
+""" Counters of stage 1 of a sim execution: candidates simulated, candidates skipped by the
+    surrogate, and route cache hits / misses (routes reused / simulated from scratch) """
+def getSimStats(cache, surrogate, nSimulated):
+    return {
+        "simulated": nSimulated,
+        "surrogateSkips": surrogate.nSkipped if surrogate is not None else 0,
+        "cacheHits": cache.hits if cache is not None else 0,
+        "cacheMisses": cache.misses if cache is not None else 0
+    }
+
+""" Simulate sols with the engine (and route cache, if any) selected in the test """
+def simulateSols(test, sols, nRuns, routeMaxCost, cache = None, bank = None, costModel = None,
+        stage = SEARCH_STAGE):
+    if test.simEngine != "vectorized":
+        for sol in sols:
+            simulation(sol, nRuns, routeMaxCost, test.varLevel, test.simEngine, costModel,
+                getRNG(test, SIM_STREAM, stage, getSolsKey([sol])))
+    elif cache is not None: # only the runs not simulated before are simulated (cache stream)
+        simulateCached(sols, cache, routeMaxCost, test.varLevel, nRuns, bank = bank, costModel = costModel)
+    else: # all sols in one pass over the same scenarios
+        simulateMany(sols, nRuns, routeMaxCost, test.varLevel, bank = bank, costModel = costModel,
+            rng = getRNG(test, SIM_STREAM, stage, getSolsKey(sols)))
+
+""" Simulate sol and check whether it beats rival in a stoch env, racing them if selected """
+def isBetterSim(test, sol, rival, nRuns, routeMaxCost, cache = None, bank = None, costModel = None):
+    if test.racing == True and cache is not None:
+        return raceSimulation(sol, rival, nRuns, cache, routeMaxCost, test.varLevel, test.raceBlock,
+            bank = bank, costModel = costModel)
+    simulateSols(test, [sol], nRuns, routeMaxCost, cache, bank, costModel)
+    return sol.reward_sim > rival.reward_sim
+
+""" Check, without simulation, whether sol has no chance to beat rival in a stoch env """
+def isHopeless(test, sol, rival, routeMaxCost, costModel = None):
+    if test.prescreenLevel <= 0 or (costModel is not None and costModel.travelModel is not None):
+        return False # no analytic approx. for learned travel-time models
+    if rival.reward_approx is None:
+        approxSimulation([rival], routeMaxCost, test.varLevel, costModel)
+    approxSimulation([sol], routeMaxCost, test.varLevel, costModel)
+    return sol.reward_approx < test.prescreenLevel * rival.reward_approx
+
+""" Scenario bank of a stage of the test, so that all its sols are compared on the same scenarios """
+def getScenarioBank(test, stage = SEARCH_STAGE):
+    if test.useCRN == False or test.simEngine != "vectorized":
+        return None # independent scenarios for each simulation
+    return ScenarioBank(max(test.shortSim, test.longSim), test.seed, getSampler(test.sampler), stage)
+
+""" Route-level cache of simulation results for the sims of a stage of the test """
+def getRouteCache(test, fleetSize, bank, stage = SEARCH_STAGE):
+    if test.simEngine != "vectorized":
+        return None
+    if test.routeCacheSize > 0:
+        return RouteCache(max(test.shortSim, test.longSim), test.routeCacheSize, bank, getRNG(test, CACHE_STREAM, stage))
+    if test.stage2Budget > 0: # just room for the routes of the elite sols
+        return RouteCache(max(test.shortSim, test.longSim), 10 * fleetSize, bank, getRNG(test, CACHE_STREAM, stage))
+    if test.racing == True: # just room for the routes of two racing sols
+        return RouteCache(max(test.shortSim, test.longSim), 2 * fleetSize, bank, getRNG(test, CACHE_STREAM, stage))
+    return None
+
+# Random streams of a test: children of SeedSequence(test.seed), addressed by their position
+# in the spawn tree, i.e. SeedSequence(test.seed).spawn(...)[a].spawn(...)[b] for key (a, b).
+# Each search chunk, each simulated set of sols and (within the cache stream) each route gets
+# its own stream, so results do not depend on the number of workers, on the order in which
+# streams are created, nor on which candidate simulates a cached route first. The cache and
+# sim streams (and the scenario bank) of stage 2 are not those of stage 1, so the final
+# estimates of the elite sols are independent of the runs that selected them
+SEARCH_STREAM, CACHE_STREAM, SIM_STREAM = 0, 1, 2
+
+""" Generator (PCG64) of the stream of the test with the given key """
+def getRNG(test, *key):
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(test.seed, spawn_key = key)))
+
+""" Key of a set of sols, from the node sequences of their routes """
+def getSolsKey(sols):
+    return zlib.crc32(repr([getRouteSignature(route) for sol in sols for route in sol.routes]).encode())
+
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
-                    GENERATE DUMMY SOLUTION
+    SEARCH FOR NEW DET SOLS (SERIAL OR PARALLEL BIASED-RANDOMIZED MERGING)
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# Yields, until test.maxTime, the new det sols whose reward beats getThreshold() (e.g., the
+# reward of the best sol so far). With test.nWorkers > 1, the merging processes run in a pool
+# of worker processes, in chunks of test.chunkSize processes: chunk c uses its own stream of
+# random numbers (see getRNG), and chunks are consumed in order, so the sols
+# only depend on the seed and the number of workers (and on how many merging processes fit
+# in maxTime)
+def searchSols(test, fleetSize, routeMaxCost, workspace, eff_list, random_numbers, getThreshold,
+        start_time, keepAll = False):
+    if test.nWorkers > 1:
+        yield from parallelSearch(test, fleetSize, routeMaxCost, workspace.instance, eff_list,
+            len(random_numbers), getThreshold, start_time, keepAll)
+        return
+    elapsed = 0
+    while elapsed < test.maxTime:
+        new_reward = merging(True, test, fleetSize, routeMaxCost, workspace, eff_list, random_numbers)
+        if new_reward > getThreshold():
+            yield getSolution(workspace)
+        elapsed = time.time() - start_time
 
-""" Generate Dummy Solution """
-def dummySolution(routeMaxCost, nodes):
-    sol = Solution()
-    for node in nodes[1:-1]: # excludes the start and finish depots
-        snEdge = node.dnEdge
-        nfEdge = node.ndEdge
-        snfRoute = Route() # construct the route (start, node, finish)
-        snfRoute.edges.append(snEdge)
-        snfRoute.reward += node.reward
-        snfRoute.cost += snEdge.cost
-        snfRoute.edges.append(nfEdge)
-        snfRoute.cost += nfEdge.cost
-        node.inRoute = snfRoute # save in node a reference to its current route
-        node.isLinkedToStart = True # this node is currently linked to start depot
-        node.isLinkedToFinish = True # this node is currently linked to finish depot
-        if snfRoute.cost <= routeMaxCost:
-            sol.routes.append(snfRoute) # add this route to the solution
-            sol.cost += snfRoute.cost
-            sol.reward += snfRoute.reward # total reward in route
-
-    return sol
+""" Coordinator of the parallel search: keeps one chunk per worker in progress until the deadline
+    (start_time + test.maxTime), which the workers also check after each merging process. Instance
+    arrays and the efficiency list are shared with the workers through shared memory (no copies) """
+def parallelSearch(test, fleetSize, routeMaxCost, instance, eff_list, streamSize, getThreshold,
+        start_time, keepAll = False):
+    deadline = start_time + test.maxTime
+    shared = SharedArrays(dict(instance.getArrays(), effOrder = eff_list.order.obj, effRank = eff_list.rank.obj))
+    pool = ProcessPoolExecutor(test.nWorkers, initializer = initSearchWorker,
+        initargs = (test, fleetSize, routeMaxCost, shared.spec, streamSize))
+    try:
+        pending = collections.deque() # chunks in progress, in order
+        for chunk in range(test.nWorkers):
+            pending.append(pool.submit(runSearchChunk, chunk, getThreshold(), keepAll, deadline))
+        nextChunk = test.nWorkers
+        while len(pending) > 0: # chunks in progress stop at the deadline, and their sols are kept
+            for record in pending.popleft().result():
+                yield buildSolution(instance, record)
+            if time.time() < deadline:
+                pending.append(pool.submit(runSearchChunk, nextChunk, getThreshold(), keepAll, deadline))
+                nextChunk += 1
+    finally: # e.g., the consumer stopped early: chunks not started yet are discarded
+        pool.shutdown(wait = True, cancel_futures = True)
+        shared.close(unlink = True)
+
+workerState = {} # data of the search in each worker process
+
+""" Initializer of each worker process: its own workspace over the shared instance arrays """
+def initSearchWorker(test, fleetSize, routeMaxCost, sharedSpec, streamSize):
+    shared = SharedArrays(spec = sharedSpec)
+    arrays = shared.arrays
+    nodes = [Node(ID, x, y, reward) for ID, ((x, y), reward) in
+        enumerate(zip(arrays["coords"].tolist(), arrays["rewards"].tolist()))]
+    instance = Instance(nodes, arrays)
+    workerState["shared"] = shared # keeps the segments attached
+    workerState["test"] = test
+    workerState["fleetSize"] = fleetSize
+    workerState["routeMaxCost"] = routeMaxCost
+    workerState["workspace"] = MergingWorkspace(instance, routeMaxCost)
+    workerState["eff_list"] = EfficiencyList(arrays["effOrder"], arrays["effRank"])
+    workerState["streamSize"] = streamSize
+
+""" Runs a chunk of merging processes in a worker, until the deadline, and returns the records of
+    the sols that beat threshold (only the improving ones, unless keepAll, and without repetitions) """
+def runSearchChunk(chunk, threshold, keepAll, deadline):
+    test = workerState["test"]
+    workspace = workerState["workspace"]
+    # at most 2 random numbers per edge in each merging process, as in getRandomPosition
+    streamSize = min(workerState["streamSize"], 2 * workspace.instance.nEdges * test.chunkSize)
+    random_numbers = getRNG(test, SEARCH_STREAM, chunk).random(streamSize) # array, read in blocks by merging
+    test.index1 = 0
+    records = []
+    seen = set()
+    for i in range(test.chunkSize):
+        if time.time() >= deadline:
+            break
+        new_reward = merging(True, test, workerState["fleetSize"], workerState["routeMaxCost"], workspace,
+            workerState["eff_list"], random_numbers)
+        if new_reward > threshold:
+            record = getSolutionRecord(workspace)
+            key = tuple(tuple(edges) for ID, cost, reward, edges in record[2])
+            if key not in seen:
+                seen.add(key)
+                records.append(record)
+            if keepAll == False:
+                threshold = new_reward
+    return records
 
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
     SELECT ALPHA, BUILD THE EFFICIENCY LIST AND GENERATE AN INITIAL SOLUTION
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 
-def genInitSol(test, fleetSize, routeMaxCost, nodes, random_numbers):
+def genInitSol(test, fleetSize, routeMaxCost, workspace, random_numbers):
     # tune the alpha value for generating enhanced savings
     best_reward = 0
     eff_list = []
     for new_alpha in np.linspace(0, 1, 11):
-        new_effList = generateEfficiencyList(nodes, new_alpha)
+        new_effList = generateEfficiencyList(workspace.instance, new_alpha)
         # obtain a greedy solution (BR = False) for the current alpha value
-        sol = merging(True, test, fleetSize, routeMaxCost, nodes, new_effList, random_numbers)
-        if sol.reward > best_reward:
-            best_reward = sol.reward
+        reward = merging(True, test, fleetSize, routeMaxCost, workspace, new_effList, random_numbers)
+        if reward > best_reward:
+            best_reward = reward
             eff_list = new_effList
-            init_sol = sol
+            init_sol = getSolution(workspace)
 
     return init_sol, eff_list
 
@@ -132,112 +310,115 @@ def genInitSol(test, fleetSize, routeMaxCost, nodes, random_numbers):
                     GENERATE EFFICIENCY LIST
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 
-""" Generate efficiency list of nodes: construct edges and effList from nodes """
-def generateEfficiencyList(nodes, alpha):
-    start = nodes[0]
-    finish = nodes[-1]
-    for node in nodes[1:-1]: # excludes the start and finish depots
-        snEdge = Edge(start, node) # creates the (start, node) edge (arc)
-        nfEdge = Edge(node, finish) # creates the (node, finish) edge (arc)
-        # compute the Euclidean distance as cost
-        snEdge.cost = math.sqrt((node.x - start.x)**2 + (node.y - start.y)**2)
-        nfEdge.cost = math.sqrt((node.x - finish.x)**2 + (node.y - finish.y)**2)
-        # save in node a reference to the (depot, node) edge (arc)
-        node.dnEdge = snEdge
-        node.ndEdge = nfEdge
-
-    efficiencyList = []
-    for i in range(1, len(nodes) - 2): # excludes the start and finish depots
-        iNode = nodes[i]
-        for j in range(i + 1, len(nodes) - 1):
-            jNode = nodes[j]
-            ijEdge = Edge(iNode, jNode) # creates the (i, j) edge
-            jiEdge = Edge(jNode, iNode)
-            ijEdge.invEdge = jiEdge # sets the inverse edge (arc)
-            jiEdge.invEdge = ijEdge
-            # compute the Euclidean distance as cost
-            ijEdge.cost = math.sqrt((jNode.x - iNode.x)**2 + (jNode.y - iNode.y)**2)
-            jiEdge.cost = ijEdge.cost # assume symmetric costs
-            # compute efficiency as proposed by Panadero et al.(2020)
-            ijSavings = iNode.ndEdge.cost + jNode.dnEdge.cost - ijEdge.cost
-            edgeReward = iNode.reward + jNode.reward
-            ijEdge.savings = ijSavings
-            ijEdge.efficiency = alpha * ijSavings + (1 - alpha) * edgeReward
-            jiSavings = jNode.ndEdge.cost + iNode.dnEdge.cost - jiEdge.cost
-            jiEdge.savings = jiSavings
-            jiEdge.efficiency = alpha * jiSavings + (1 - alpha) * edgeReward
-            # save both edges in the efficiency list
-            efficiencyList.append(ijEdge)
-            efficiencyList.append(jiEdge)
-
-    # sort the list of edges from higher to lower efficiency
-    efficiencyList.sort(key = operator.attrgetter("efficiency"), reverse = True)
+""" Generate efficiency list: order the instance edges by efficiency for a given alpha """
+def generateEfficiencyList(instance, alpha):
+    # compute efficiency as proposed by Panadero et al.(2020), for all edges at once
+    efficiency = alpha * instance.edgeSavings + (1 - alpha) * instance.edgeReward
+    # sort the edge indices from higher to lower efficiency (ties keep the edge order)
+    order = np.argsort(-efficiency, kind = "stable")
+    efficiencyList = EfficiencyList(order)
     return efficiencyList
 
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
             MERGING PROCESS IN THE PJ'S HEURISTIC
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 
-""" Perform the BR edge-selection & routing-merging iterative process """
-def merging(useBR, test, fleetSize, routeMaxCost, nodes, eff_list, random_numbers):
-    sol = dummySolution(routeMaxCost, nodes) # compute the dummy solution
-    effList = copy.copy(eff_list) # make a shallow copy of the effList since it will be modified
-    while len(effList) > 0: # list is not empty
+""" Perform the BR edge-selection & routing-merging iterative process in the workspace """
+def merging(useBR, test, fleetSize, routeMaxCost, workspace, eff_list, random_numbers):
+    workspace.reset(eff_list) # back to the dummy solution and a full efficiency list
+    effList = workspace.effList
+    routeCost = workspace.routeCost
+    routeReward = workspace.routeReward
+    routeLast = workspace.routeLast
+    inSol = workspace.inSol
+    isFirst = workspace.isFirst
+    lastOf = workspace.lastOf
+    links = workspace.links
+    edgeOrigin = workspace.edgeOrigin
+    edgeEnd = workspace.edgeEnd
+    if useBR == True: # at most 1 position per edge, sampled in a block (see getPositionBlock)
+        positions = getPositionBlock(test, test.firstParam, test.secondParam, effList.size, random_numbers)
+        nPositions = 0
+    while effList.size > 0: # list is not empty
         position = 0
-        if useBR == True:
-            position = getRandomPosition(test, test.firstParam, test.secondParam, len(effList), random_numbers)
+        if useBR == True: # as getRandomPosition, with the next position of the block
+            position = positions[nPositions] % effList.size
+            nPositions += 1
         else:
             position = 0  # greedy behavior
-        ijEdge = effList.pop(position) # select the next edge from the list
+        ijEdge = effList.pop(position) # select the next edge (its index) from the list
         # determine the nodes i < j that define the edge
-        iNode = ijEdge.origin
-        jNode = ijEdge.end
-        # determine the routes associated with each node
-        iRoute = iNode.inRoute
-        jRoute = jNode.inRoute
-        # check if merge is possible
-        isMergeFeasible = checkMergingConditions(iNode, jNode, iRoute, jRoute, ijEdge, routeMaxCost)
+        i = edgeOrigin[ijEdge]
+        j = edgeEnd[ijEdge]
+        # determine the route ending at node i and the route starting at node j (route j)
+        iRoute = lastOf[i]
+        # check if merge is possible (most edges fail the cheap endpoint test)
+        isMergeFeasible = iRoute is not None and isFirst[j] and \
+            checkMergingConditions(workspace, iRoute, j, ijEdge, routeMaxCost)
         # if all necessary conditions are satisfied, merge and delete edge (j, i)
         if isMergeFeasible == True:
         # if still in list, delete edge (j, i) since it will not be used
-            jiEdge = ijEdge.invEdge
+            jiEdge = ijEdge ^ 1 # edges come in (i, j), (j, i) pairs
             if jiEdge in effList:
                 effList.remove(jiEdge)
-            # iRoute will contain edge (i, finish)
-            iEdge = iRoute.edges[-1] # iEdge is (i, finish)
-            # remove iEdge from iRoute and update iRoute cost
-            iRoute.edges.remove(iEdge)
-            iRoute.cost -= iEdge.cost
-            # node i will not be linked to finish depot anymore
-            iNode.isLinkedToFinish = False
-            # jRoute will contain edge (start, j)
-            jEdge = jRoute.edges[0]
-            # remove jEdge from jRoute and update jRoute cost
-            jRoute.edges.remove(jEdge)
-            jRoute.cost -= jEdge.cost
-            # node j will not be linked to start depot anymore
-            jNode.isLinkedToStart = False
-            # add ijEdge to iRoute
-            iRoute.edges.append(ijEdge)
-            iRoute.cost += ijEdge.cost
-            iRoute.reward += jNode.reward
-            jNode.inRoute = iRoute
-            # add jRoute to new iRoute
-            for edge in jRoute.edges:
-                iRoute.edges.append(edge)
-                iRoute.cost += edge.cost
-                iRoute.reward += edge.end.reward
-                edge.end.inRoute = iRoute
-            # delete jRoute from emerging solution
-            sol.cost -= ijEdge.savings
-            sol.routes.remove(jRoute)
-
+            # replace edges (i, finish) and (start, j) by edge (i, j) and splice route j into iRoute
+            routeCost[iRoute] += routeCost[j] - workspace.ndCost[i] - workspace.dnCost[j] + workspace.edgeCost[ijEdge]
+            routeReward[iRoute] += routeReward[j]
+            links[i] = ijEdge
+            # node i will not be linked to finish depot anymore, nor node j to start depot
+            lastOf[i] = None
+            isFirst[j] = False
+            lastOf[routeLast[j]] = iRoute
+            routeLast[iRoute] = routeLast[j]
+            # delete route j from emerging solution
+            workspace.solCost -= workspace.edgeSavings[ijEdge]
+            inSol[j] = False
+
+    if useBR == True: # the random numbers not used are left for the next merging process
+        test.index1 = (test.index1 + 2 * nPositions) % len(random_numbers)
     # sort the list of routes in sol by reward (reward) and delete extra routes
-    sol.routes.sort(key = operator.attrgetter("reward"), reverse = True)
-    for route in sol.routes[fleetSize:]:
-        sol.reward -= route.reward # update reward
-        sol.cost -= route.cost # update cost
-        sol.routes.remove(route) # delete extra route
+    routes = sorted(filter(inSol.__getitem__, workspace.routeIDs), key = routeReward.__getitem__, reverse = True)
+    for route in routes[fleetSize:]:
+        workspace.solReward -= routeReward[route] # update reward
+        workspace.solCost -= routeCost[route] # update cost
+    workspace.solRoutes = routes[:fleetSize]
+    return workspace.solReward
+
+""" Build a Solution object from the routes kept in the workspace """
+def getSolution(workspace):
+    return buildSolution(workspace.instance, getSolutionRecord(workspace))
+
+""" Compact copy of the emerging solution: cost, reward and, for each route, its first node ID,
+    cost, reward and edge indices (e.g. to send it between processes) """
+def getSolutionRecord(workspace):
+    routes = []
+    for ID in workspace.solRoutes:
+        edges = [] # indices of the customer edges of the route, in order
+        node = ID
+        while node != workspace.routeLast[ID]:
+            edges.append(workspace.links[node])
+            node = workspace.edgeEnd[edges[-1]]
+        routes.append((ID, workspace.routeCost[ID], workspace.routeReward[ID], edges))
+    return workspace.solCost, workspace.solReward, routes
+
+""" Build a Solution from its record """
+def buildSolution(instance, record):
+    solCost, solReward, routes = record
+    nodes = instance.nodes
+    sol = Solution()
+    sol.cost = solCost
+    sol.reward = solReward
+    links = [None] * len(nodes) # links of this solution only, shared by its routes
+    for ID, cost, reward, edges in routes:
+        route = Route(nodes[ID], links)
+        route.cost = cost
+        route.reward = reward
+        for k in edges:
+            edge = instance.getEdge(k)
+            links[edge.origin.ID] = edge
+        if len(edges) > 0: # else, route.last = route.first
+            route.last = instance.getEdge(edges[-1]).end
+        sol.routes.append(route)
     return sol
 
 
@@ -252,6 +433,35 @@ def getRand(test, random_numbers):
     # Return the random number at the specified index
     return a
 
+""" Gets the next n random numbers of the stream as an array, without moving test.index1 """
+def getRandBlock(test, random_numbers, n):
+    parts = []
+    start = test.index1
+    while n > 0: # wraps around the end of the stream, as getRand
+        end = min(start + n, len(random_numbers))
+        parts.append(np.asarray(random_numbers[start:end], dtype = float)) # e.g., a memory map
+        n -= end - start
+        start = 0
+    return np.concatenate(parts)
+
+""" Gets the next n Geometric(beta) indices of getRandomPosition (before the modulo size, which
+    changes as the list shrinks), without moving test.index1: index k uses random numbers 2k and
+    2k + 1 from test.index1, as n successive calls to getRandomPosition """
+def getPositionBlock(test, beta1, beta2, n, random_numbers):
+    rand = getRandBlock(test, random_numbers, 2 * n)
+    beta = beta1 + rand[0::2] * (beta2 - beta1) # same rounding as in getRandomPosition
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        index = np.log(rand[1::2])/np.log(1 - beta)
+    # np.log and math.log may differ in the last bit, which only changes int(index) if index is
+    # (almost) an integer: those indices, and the non-finite ones, are computed as before
+    tolerance = 1e-12 * np.maximum(index, 1)
+    fraction = index - np.floor(index)
+    check = ~np.isfinite(index) | (fraction < tolerance) | (1 - fraction < tolerance) | (index > 2**62)
+    index = np.floor(np.where(check, 0, index)).astype(np.int64).tolist()
+    for k in np.flatnonzero(check).tolist():
+        index[k] = int(math.log(rand[2 * k + 1])/math.log(1 - beta[k]))
+    return index
+
 """ Gets a random position according to a Gemetric(beta) """
 def getRandomPositionOld(beta1, beta2, size):
     # randomly select a beta value between beta1 and beta2
@@ -270,12 +480,12 @@ def getRandomPosition(test, beta1, beta2, size, random_numbers):
     return index
 
 """ Check if merging conditions are met """
-def checkMergingConditions(iNode, jNode, iRoute, jRoute, ijEdge, routeMaxCost):
-    # condition 1: iRoute and jRoure are not the same route object
+def checkMergingConditions(workspace, iRoute, jRoute, ijEdge, routeMaxCost):
+    # condition 1: i node has to be linked to finish and jNode to start
+    if iRoute is None or workspace.isFirst[jRoute] == False: return False
+    # condition 2: iRoute and jRoure are not the same route
     if iRoute == jRoute: return False
-    # condition 2: jNode has to be linked to start and i node to finish
-    if iNode.isLinkedToFinish == False or jNode.isLinkedToStart == False: return False
     # condition 3: cost after merging does not exceed maxTime (or maxCost)
-    if iRoute.cost + jRoute.cost - ijEdge.savings > routeMaxCost: return False
+    if workspace.routeCost[iRoute] + workspace.routeCost[jRoute] - workspace.edgeSavings[ijEdge] > routeMaxCost: return False
     # else, merging is feasible
     return True
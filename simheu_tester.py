@@ -1,87 +1,171 @@
 ''' Reviewed by Angel A. Juan 2023.06 for the TOP with stochastic / dynamic travel times '''
-import csv
+import io
 import os
+import math
 import random
+import argparse
+import contextlib
 import numpy as np
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from aux_functions import read_tests, read_instance, printRoutes
+from aux_functions import read_tests, read_instance, printRoutes, get_test_key, get_result_key, \
+    open_results, write_result, sort_results, read_random_numbers
+from aux_objects import Instance
 from simheu import detExcecution, simExcecution, getRand
 
-# Read the tests2run.txt file and build the list of instances (tests) to run
-file_name = "tests" + os.sep + "tests2run.txt"
-tests = read_tests(file_name)
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+        EXECUTION OF A SINGLE TEST
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 
-# Create a list to store the results
-results = []
-
-# Initialize an index to keep track of the current random number
-#random_index = 0
-#maxIterations = 100.000
-# For each instance (test), read inputs, create nodes, and execute it
-for test in tests:
-
-    # Use the getRand function to obtain a random number at the current index
-    #test.random_value, test.index1 = getRand(index1, random_file)
-    # Define the path to the random data file
-    random_file = "random_numbers.txt"
-
-    # Initialize the index to 0
+""" Run a test (OBD and OBS sols) and return its row of results """
+def runTest(test, random_numbers, verbose = False):
+    # Initialize the index to 0: each test starts the random numbers from the beginning
     test.index1 = 0
 
-    # open and read the random numers from the text file:
-    with open("random_numbers.txt", "r") as random_file:
-        random_numbers = [float(line.strip()) for line in random_file]
-
     # set the seed in the RNG for reproducibility purposes
-    #random.seed(test.seed) # Python default RNG, used during BR
-    #np.random.seed(test.seed) # Numpy RNG, used during simulation
+    random.seed(test.seed) # Python default RNG, used during BR
+    np.random.seed(test.seed) # Numpy RNG, used during simulation
     # print basic instance info
     print('\nInstance: ', test.instanceName)
     print('Var level (k in Var = k*mean):', test.varLevel)
     # read input data from instance file
     file_name = "data" + os.sep + test.instanceName + ".txt"
     fleetSize, routeMaxCost, nodes = read_instance(file_name)
+    # precompute distances, savings and the edge graph shared by both executions
+    instance = Instance(nodes)
     # execute the algorithm and obtain the different Our Best solutions, where
     # OBD = Our Best Deterministic sol
     # OBS = Our Best Stochastic sol
 
-    OBD = detExcecution(test, fleetSize, routeMaxCost, nodes, random_numbers)
-    OBS = simExcecution(test, fleetSize, routeMaxCost, nodes, random_numbers)
-
+    OBD = detExcecution(test, fleetSize, routeMaxCost, instance, random_numbers)
+    OBS = simExcecution(test, fleetSize, routeMaxCost, instance, random_numbers)
 
-    # Append the results to the list
-    results.append({
+    # Print summary results
+    print('Reward for OBD sol in a Det. env. =', OBD.reward)
+    print('Reward for OBD sol in a Stoch. env. =', OBD.reward_sim)
+    print('Reward for OBS sol in a Stoch. env. =', OBS.reward_sim)
+    print('Standard error of this reward =', OBS.reward_se)
+    print('Confidence that OBS is the best elite sol =', OBS.confidence)
+    stats = test.simStats
+    print('Candidates simulated / skipped by the surrogate =', stats["simulated"], '/', stats["surrogateSkips"])
+    print('Route cache hits / misses =', stats["cacheHits"], '/', stats["cacheMisses"])
+    if verbose: # route dumps slow down large batches
+        print('Routes for OBD sol')
+        printRoutes(OBD)
+        print('Routes for OBS sol')
+        printRoutes(OBS)
+
+    return {
         'Instance': test.instanceName,
         "Seed": test.seed,
         'OBD': OBD.reward,
         'OBD-S': OBD.reward_sim,
         'OBS': OBS.reward_sim,
         "OBD_T": OBD.time,
-        "OBS_T": OBS.time
-    })
-
-    # Print summary results
-    print('Reward for OBD sol in a Det. env. =', OBD.reward)
-    print('Reward for OBD sol in a Stoch. env. =', OBD.reward_sim)
-    print('Reward for OBS sol in a Stoch. env. =', OBS.reward_sim)
-    print('Routes for OBD sol')
-    printRoutes(OBD)
-    print('Routes for OBS sol')
-    printRoutes(OBS)
-
-# Define the output CSV file path
-output_file = 'results_Rand_PY.csv'
-
-# Write the results to the CSV file
-fieldnames = ['Instance', "Seed", 'OBD', 'OBD-S', 'OBS', "OBD_T", "OBS_T"]
-
-with open(output_file, 'w', newline='') as csvfile:
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(results)
-
-print("Results saved to", output_file)
-
-
-
+        "OBS_T": OBS.time,
+        "VarLevel": test.varLevel,
+        "MaxTime": test.maxTime
+    }
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+        BATCH EXECUTION IN A PROCESS POOL
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# Each test runs in a worker process, with its own index1 and seeds (see runTest), so its
+# results do not depend on the other tests of the batch. Longest tests are started first
+# (LPT scheduling), so that no long test is left alone running at the end of the batch
+
+batchState = {} # random numbers of the worker process, opened once by initBatchWorker
+
+""" Expected running time of a test: maxTime in each execution, plus the final sims """
+def getExpectedTime(test):
+    file_name = "data" + os.sep + test.instanceName + ".txt"
+    with open(file_name) as instance:
+        nNodes = int(instance.readline().split(';')[1])
+    return (2 * test.maxTime, nNodes * test.longSim)
+
+""" Initializer of each batch worker """
+def initBatchWorker(random_file):
+    batchState["random_numbers"] = read_random_numbers(random_file)
+
+""" Run a test in a batch worker and return its row of results and its console output """
+def runBatchTest(test, verbose):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = runTest(test, batchState["random_numbers"], verbose)
+    return result, output.getvalue()
+
+""" Expected running time of a test that can be sorted (tests that cannot be read go first, and fail fast) """
+def getSortKey(test):
+    try:
+        return getExpectedTime(test)
+    except Exception:
+        return (math.inf, math.inf)
+
+""" Report a test that failed, which is left out of the results (so --resume runs it again) """
+def reportFailure(test, error, failed):
+    print("\nTest", get_test_key(test), "failed:", repr(error))
+    failed.append((test, error))
+
+""" Run the tests in nProcesses processes and yield their rows of results as they finish. A test
+    that raises an exception does not stop the batch: it is reported and appended to failed """
+def runBatch(tests, nProcesses, random_file = "random_numbers.txt", verbose = False, failed = None):
+    if failed is None:
+        failed = []
+    if nProcesses <= 1: # serial execution in this process
+        random_numbers = read_random_numbers(random_file)
+        for test in tests:
+            try:
+                result = runTest(test, random_numbers, verbose)
+            except Exception as error:
+                reportFailure(test, error, failed)
+                continue
+            yield result
+        return
+    read_random_numbers(random_file) # builds the binary copy once, before the workers open it
+    tests = sorted(tests, key = getSortKey, reverse = True)
+    with ProcessPoolExecutor(nProcesses, initializer = initBatchWorker, initargs = (random_file,)) as pool:
+        futures = {pool.submit(runBatchTest, test, verbose): test for test in tests}
+        for future in as_completed(futures):
+            try:
+                result, output = future.result()
+            except Exception as error:
+                reportFailure(futures[future], error, failed)
+                continue
+            print(output, end = "") # whole output of each test, as it finishes
+            yield result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Run the tests of a tests2run file")
+    parser.add_argument("tests_file", nargs = "?", default = "tests" + os.sep + "tests2run.txt")
+    parser.add_argument("processes", nargs = "?", type = int, default = 1, help = "tests run in parallel")
+    parser.add_argument("--output", default = "results_Rand_PY.csv", help = "results CSV file")
+    parser.add_argument("--resume", action = "store_true", help = "skip the tests already in the results file")
+    parser.add_argument("--routes", action = "store_true", help = "print the routes of the OBD and OBS sols")
+    args = parser.parse_args()
+
+    # Read the tests2run.txt file and build the list of instances (tests) to run
+    tests = read_tests(args.tests_file)
+
+    # Open the results file: each row is written as soon as its test finishes, so a crash
+    # only loses the tests in progress, which are run again with --resume. Once all the
+    # tests are run, the rows are sorted in the order of the tests file
+    fieldnames = ['Instance', "Seed", 'OBD', 'OBD-S', 'OBS', "OBD_T", "OBS_T", "VarLevel", "MaxTime"]
+    csvfile, writer, done = open_results(args.output, fieldnames, args.resume)
+    doneKeys = set(get_result_key(row) for row in done)
+    allTests = tests
+    tests = [test for test in tests if get_test_key(test) not in doneKeys]
+    print(len(done), "results kept in", args.output, "-", len(tests), "tests to run")
+
+    # For each instance (test), read inputs, create nodes, and execute it
+    failed = []
+    with csvfile:
+        for result in runBatch(tests, args.processes, verbose = args.routes, failed = failed):
+            write_result(csvfile, writer, result)
+    sort_results(args.output, fieldnames, allTests)
+
+    print("Results saved to", args.output)
+    if len(failed) > 0: # they have no row, so --resume only runs them again
+        print(len(failed), "tests failed (run again with --resume):")
+        for test, error in failed:
+            print(" ", get_test_key(test), repr(error))
@@ -1,19 +1,29 @@
 ''' Reviewed by Angel A. Juan 2023.06 for the TOP with stochastic / dynamic travel times '''
-import csv
 import os
 import random
+import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 
-from aux_functions import read_tests, read_instance, printRoutes
+from aux_functions import read_tests, read_instance, printRoutes, get_test_key, get_result_key, \
+    open_results, write_result
 from simheu1 import detExcecution, simExcecution
 
+parser = argparse.ArgumentParser(description = "Run the tests of a tests2run file (det. execution only)")
+parser.add_argument("tests_file", nargs = "?", default = "tests" + os.sep + "tests2run.txt")
+parser.add_argument("--output", default = "results_Python_TimeHeu.csv", help = "results CSV file")
+parser.add_argument("--resume", action = "store_true", help = "skip the tests already in the results file")
+parser.add_argument("--routes", action = "store_true", help = "print the routes of the OBD sol")
+args = parser.parse_args()
+
 # Read the tests2run.txt file and build the list of instances (tests) to run
-file_name = "tests" + os.sep + "tests2run.txt"
-tests = read_tests(file_name)
+tests = read_tests(args.tests_file)
 
-# Create a list to store the results
-results = []
+# Open the results file: each row is written as soon as its test finishes
+fieldnames = ['Instance', "Seed", 'OBD', "OBD_T", "VarLevel", "MaxTime"]
+csvfile, writer, done = open_results(args.output, fieldnames, args.resume)
+doneKeys = set(get_result_key(row) for row in done)
+tests = [test for test in tests if get_test_key(test) not in doneKeys]
 
 # Initialize an index to keep track of the current random number
 #random_index = 0
@@ -38,8 +48,8 @@ for test in tests:
     # OBS = simExcecution(test, fleetSize, routeMaxCost, nodes)
 
 
-    # Append the results to the list
-    results.append({
+    # Append the results to the results file
+    write_result(csvfile, writer, {
         'Instance': test.instanceName,
         "Seed": test.seed,
         'OBD': OBD.reward,
@@ -47,29 +57,22 @@ for test in tests:
         #'OBS': OBS.reward_sim,
         "OBD_T": OBD.time,
         #"OBS_T": OBS.time
+        "VarLevel": test.varLevel,
+        "MaxTime": test.maxTime
     })
 
     # Print summary results
     print('Reward for OBD sol in a Det. env. =', OBD.reward)
     #print('Reward for OBD sol in a Stoch. env. =', OBD.reward_sim)
     #print('Reward for OBS sol in a Stoch. env. =', OBS.reward_sim)
-    print('Routes for OBD sol')
-    printRoutes(OBD)
-    #print('Routes for OBS sol')
-    #printRoutes(OBS)
-
-# Define the output CSV file path
-output_file = 'results_Python_TimeHeu.csv'
-
-# Write the results to the CSV file
-fieldnames = ['Instance', "Seed", 'OBD', "OBD_T"]
-
-with open(output_file, 'w', newline='') as csvfile:
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(results)
-
-print("Results saved to", output_file)
+    if args.routes:
+        print('Routes for OBD sol')
+        printRoutes(OBD)
+        #print('Routes for OBS sol')
+        #printRoutes(OBS)
+
+csvfile.close()
+print("Results saved to", args.output)
 
 
 
@@ -1,9 +1,12 @@
 ''' Reviewed by Angel A. Juan 2023.06 for the TOP with stochastic / dynamic travel times '''
 
 import math
+import zlib
 import random
 import numpy as np
 
+from aux_objects import SimLayout, RouteSim
+
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
     REVIEW THE SETTINGS (DET/STOCH/DYN) OF EACH EDGE (ARC)
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
@@ -25,11 +28,14 @@ def setEdgesType1(sol):
 ###STOCK/Dynamic EDGE####
 def setEdgesType(sol):
     for route in sol.routes:
-        for e in route.edges:
-            if e.end.ID % 2 == 0:
-                e.type = 2
-            else:
-                e.type = 0  # deterministic
+        setRouteEdgesType(route)
+
+def setRouteEdgesType(route):
+    for e in route.edges:
+        if e.end.ID % 2 == 0:
+            e.type = 2
+        else:
+            e.type = 0  # deterministic
 
 
 
@@ -40,28 +46,47 @@ def setEdgesType(sol):
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 # This code assumes deterministic rewards on each node but random / dynamic travel times (cost),
 # which might imply losing the accumulated reward in routes that exceed the max cost allowed
-def simulation(sol, nRuns, routeMaxCost, varLevel):
-    setEdgesType(sol) # for experiments, set the type of each edge (det/stoch/dyn)
+# The cost model of each edge is read from costModel (see CostModel) or, if not given, set
+# by setEdgesType and computed from the edge cost and varLevel. Random values are drawn from
+# rng (a np.random.Generator) or, if not given, from the global numpy RNG
+def simulation(sol, nRuns, routeMaxCost, varLevel, engine="loop", costModel=None, rng=None):
+    if engine == "vectorized": # see simulateMany below
+        simulateMany([sol], nRuns, routeMaxCost, varLevel, costModel=costModel, rng=rng)
+        return
+    if engine == "importance": # see importanceSimulation below
+        importanceSimulation([sol], nRuns, routeMaxCost, varLevel, costModel, rng)
+        return
+    if rng is None:
+        rng = np.random
+    if costModel is None:
+        setEdgesType(sol) # for experiments, set the type of each edge (det/stoch/dyn)
+    # cost, type, lognormal params and dynamic coefs of each edge of each route
+    params = [[a.tolist() for a in getEdgeParams(route.edges, varLevel, costModel)] for route in sol.routes]
+    travelModel = costModel.travelModel if costModel is not None else None
     #weather = random.random() # daily weather adversity level, a random value between 0 (low) and 1 (high)
     #weather = np.random.random()
     accumRewardsInSol = 0 # accumulated sol rewards after multiple runs
     for i in range(0, nRuns):
-        weather = np.random.random()
+        weather = rng.random()
         rewardInSol = 0 # sol reward in this run
-        for route in sol.routes:
+        for route, (cost, eType, mu, sigma, b_w, b_t) in zip(sol.routes, params):
             routeReward = 0 # route reward in this run
             routeCost = 0 # time- or distance-based cost
-            for e in route.edges:
+            for k, e in enumerate(route.edges):
                 node = e.end # end node of the edge
                 routeReward += node.reward
-                if e.type == 0: 
-                    edgeCost = e.cost
-                elif e.type == 1: # edge e has a stochastic travel time
-                    edgeCost = getStochasticValue(mean=e.cost, varLevel=varLevel)
-                elif e.type == 2: # edge e has a dynamic travel time depending upon weather and traffic
+                if eType[k] == 0:
+                    edgeCost = cost[k]
+                elif eType[k] == 1: # edge e has a stochastic travel time
+                    edgeCost = rng.lognormal(mean=mu[k], sigma=sigma[k])
+                elif eType[k] == 2: # edge e has a dynamic travel time depending upon weather and traffic
                     #traffic = random.random() # edge traffic adversity level, between 0 (low) and 1 (high)
-                    traffic = np.random.random()
-                    edgeCost = getDynamicValue(e, weather, traffic) 
+                    traffic = rng.random()
+                    if travelModel is None:
+                        edgeCost = cost[k] + b_w[k]*weather + b_t[k]*traffic # see getDynamicValue
+                    else: # a single prediction (see the vectorized engine for batches)
+                        edgeCost = travelModel.getCosts([(e.origin.ID, e.end.ID)], getEdgeFeatures([e], costModel),
+                            np.array([weather]), np.array([[traffic]]))[0, 0]
                 routeCost += edgeCost
             
             if routeCost > routeMaxCost: # violates constraint on max cost
@@ -74,6 +99,326 @@ def simulation(sol, nRuns, routeMaxCost, varLevel):
 
         accumRewardsInSol += rewardInSol
     sol.reward_sim = accumRewardsInSol / nRuns # reward refers to reward
+    sol.nRuns_sim = nRuns
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+    VECTORIZED MONTE CARLO SIMULATION (BLOCKS OF RUNS AT ONCE)
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# Same cost model as simulation(), but all the weather, traffic and lognormal values
+# of a block of runs are drawn in one call and route costs are summed per segment. Each block
+# draws from its own child stream of rng (see getBlockRNGs).
+# Simulates many sols against the same sampled scenarios: each run has one weather value
+# and one value per distinct edge, shared by all the sols that traverse that edge. With a
+# scenario bank, the first nRuns scenarios of the bank are used (common random numbers).
+# Sets reward_sim in each sol and returns the sol rewards in each run, shape (nSols, nRuns)
+def simulateMany(sols, nRuns, routeMaxCost, varLevel, blockSize=1000, bank=None, costModel=None, rng=None):
+    rewards = np.zeros((len(sols), nRuns)) # reward of each sol in each run
+    routes = [route for sol in sols for route in sol.routes]
+    if len(routes) > 0:
+        layout = buildSimLayout(routes, varLevel, costModel)
+        # solRewards[r, s] = reward of route r if it belongs to sol s, and 0 otherwise
+        solRewards = np.zeros((len(routes), len(sols)))
+        solRewards[np.arange(len(routes)), np.repeat(np.arange(len(sols)), [len(sol.routes) for sol in sols])] = layout.routeRewards
+        blockRNGs = getBlockRNGs(rng, len(range(0, nRuns, blockSize)))
+        for first, blockRNG in zip(range(0, nRuns, blockSize), blockRNGs):
+            nBlock = min(blockSize, nRuns - first)
+            if bank is None:
+                weather = blockRNG.random(nBlock) # daily weather adversity level of each run
+            else:
+                weather = bank.weather[first:first + nBlock]
+            routeCosts = sampleRouteCosts(layout, weather, bank, first, blockRNG)
+            # penalty for violating the max cost allowed per route: the route reward is lost
+            rewards[:, first:first + nBlock] = ((routeCosts <= routeMaxCost) @ solRewards).T
+    setRewardSim(sols, rewards)
+    return rewards
+
+# Simulates sols route by route on the first nRuns runs of the cache: routes found in the
+# cache reuse their stored results, and only the missing runs of each route are simulated
+def simulateCached(sols, cache, routeMaxCost, varLevel, nRuns=None, blockSize=1000, bank=None,
+        costModel=None):
+    if nRuns is None:
+        nRuns = cache.nRuns
+    routeSims = simulateRoutes([route for sol in sols for route in sol.routes], nRuns, cache,
+        routeMaxCost, varLevel, blockSize, bank, costModel)
+    rewards = np.zeros((len(sols), nRuns)) # reward of each sol in each run
+    for s, sol in enumerate(sols):
+        for route in sol.routes:
+            routeSim = routeSims[getRouteSignature(route)]
+            rewards[s] += routeSim.reward * routeSim.ok[:nRuns]
+    setRewardSim(sols, rewards)
+    return rewards
+
+# Makes sure that the first nRuns runs of each route are in the cache and returns the RouteSim
+# of each route, by signature. With a bank, the missing runs of all routes are simulated at once
+# from the bank. Else, with a cache stream, each route is simulated on its own from streams keyed
+# by the route (see getRouteRNG), so its runs do not depend on which sol simulates it first nor
+# on how its runs are extended; without a stream, all routes draw from the global numpy RNG
+def simulateRoutes(routes, nRuns, cache, routeMaxCost, varLevel, blockSize=1000, bank=None,
+        costModel=None):
+    routeSims = {}
+    missing = {} # routes to extend, grouped by the first run to simulate
+    for route in routes:
+        key = getRouteSignature(route)
+        if key in routeSims:
+            continue
+        routeSim = cache.get(key)
+        if routeSim is None:
+            routeSim = RouteSim(cache.nRuns, sum(e.end.reward for e in route.edges))
+            cache.put(key, routeSim)
+        routeSims[key] = routeSim
+        if routeSim.nDone < nRuns:
+            missing.setdefault(routeSim.nDone, []).append((route, routeSim))
+    if bank is None and cache.rng is not None:
+        for nDone, group in missing.items():
+            for route, routeSim in group:
+                simulateRouteChunks(route, routeSim, nDone, nRuns, cache, routeMaxCost, varLevel, costModel)
+        return routeSims
+    for nDone, group in missing.items():
+        layout = buildSimLayout([route for route, routeSim in group], varLevel, costModel)
+        blockRNGs = getBlockRNGs(cache.rng, len(range(nDone, nRuns, blockSize)))
+        for first, blockRNG in zip(range(nDone, nRuns, blockSize), blockRNGs):
+            last = min(first + blockSize, nRuns)
+            routeCosts = sampleRouteCosts(layout, cache.weather[first:last], bank, first, blockRNG)
+            for (route, routeSim), ok in zip(group, (routeCosts <= routeMaxCost).T):
+                routeSim.ok[first:last] = ok
+        for route, routeSim in group:
+            routeSim.nDone = nRuns
+    return routeSims
+
+# Runs are split in chunks of ROUTE_CHUNK runs, and chunk j of a route always draws from the
+# same stream: the chunks that overlap runs nDone, ..., nRuns - 1 are sampled in full, and only
+# the missing runs are stored
+ROUTE_CHUNK = 100
+
+''' Simulates runs nDone, ..., nRuns - 1 of a route from its own streams (see getRouteRNG) '''
+def simulateRouteChunks(route, routeSim, nDone, nRuns, cache, routeMaxCost, varLevel, costModel=None):
+    layout = buildSimLayout([route], varLevel, costModel)
+    routeKey = zlib.crc32(repr(getRouteSignature(route)).encode())
+    for j in range(nDone // ROUTE_CHUNK, (nRuns - 1) // ROUTE_CHUNK + 1):
+        first = j * ROUTE_CHUNK
+        last = min(first + ROUTE_CHUNK, cache.nRuns)
+        routeCosts = sampleRouteCosts(layout, cache.weather[first:last], rng=getRouteRNG(cache.rng, routeKey, j))
+        start, end = max(first, nDone), min(last, nRuns)
+        routeSim.ok[start:end] = routeCosts[start - first:end - first, 0] <= routeMaxCost
+    routeSim.nDone = nRuns
+
+''' Stream of chunk j of the runs of a route: child (routeKey, j) of the stream of rng '''
+def getRouteRNG(rng, routeKey, j):
+    seedSeq = rng.bit_generator.seed_seq
+    child = np.random.SeedSequence(seedSeq.entropy, spawn_key=seedSeq.spawn_key + (routeKey, j))
+    return np.random.Generator(type(rng.bit_generator)(child))
+
+# Sequential simulation of sol against a rival sol (e.g., the incumbent), in blocks of runs
+# on the same cache scenarios. Running mean and variance of the paired differences in reward
+# are updated per block (Welford / Chan et al.), and the race stops as soon as the confidence
+# interval lies below 0 (sol loses) or above 0 (sol wins), or after nRuns runs.
+# Sets reward_sim in sol (rival is extended to the same runs) and returns True if sol wins
+def raceSimulation(sol, rival, nRuns, cache, routeMaxCost, varLevel, blockSize=20, z=2.0,
+        minRuns=40, bank=None, costModel=None):
+    n, mean, m2 = 0, 0.0, 0.0 # runs, mean and sum of squared deviations of the differences
+    rewards = np.zeros(nRuns) # reward of sol in each run
+    rivalRewards = np.zeros(nRuns)
+    while n < nRuns:
+        last = min(n + blockSize, nRuns)
+        routeSims = simulateRoutes(sol.routes + rival.routes, last, cache, routeMaxCost, varLevel,
+            bank=bank, costModel=costModel)
+        for s, r in ((sol, rewards), (rival, rivalRewards)):
+            for route in s.routes:
+                routeSim = routeSims[getRouteSignature(route)]
+                r[n:last] += routeSim.reward * routeSim.ok[n:last]
+        diff = rewards[n:last] - rivalRewards[n:last]
+        # merge the block statistics into the running ones
+        delta = diff.mean() - mean
+        total = n + len(diff)
+        mean += delta * len(diff) / total
+        m2 += ((diff - diff.mean())**2).sum() + delta**2 * n * len(diff) / total
+        n = total
+        if n >= minRuns and n < nRuns:
+            halfWidth = z * math.sqrt(m2 / (n - 1) / n)
+            if mean + halfWidth < 0 or mean - halfWidth > 0:
+                break # sol clearly loses or clearly wins
+    setRewardSim([sol], rewards[None, :n])
+    if rival.nRuns_sim < n: # keep the most accurate estimate of the rival
+        setRewardSim([rival], rivalRewards[None, :n])
+    return mean > 0
+
+# Optimal computing budget allocation (OCBA) of about budget runs among sols, e.g. the elite
+# sols, on the same cache scenarios. Every sol gets minRuns runs first; then, in steps of
+# blockSize runs per sol, runs go to the sols whose ranking is still uncertain (close to the
+# best one and with a high variance), while sols clearly dominated by the best one (paired
+# differences) are dropped. Sets reward_sim in each sol and the estimated probability that
+# the best one is actually the best (confidence), and returns the best sol
+def ocbaSimulation(sols, budget, cache, routeMaxCost, varLevel, blockSize=20, z=2.0,
+        minRuns=40, bank=None, costModel=None):
+    nMax = cache.nRuns
+    rewards = np.zeros((len(sols), nMax)) # reward of each sol in each run
+    nRuns = np.zeros(len(sols), dtype=int) # runs done for each sol
+    target = np.full(len(sols), min(minRuns, nMax)) # runs to reach for each sol
+    alive = list(range(len(sols))) # sols not dominated yet
+    spent = 0
+    while True:
+        for i in alive: # extend each sol up to its target
+            if target[i] > nRuns[i]:
+                routeSims = simulateRoutes(sols[i].routes, target[i], cache, routeMaxCost, varLevel,
+                    bank=bank, costModel=costModel)
+                for route in sols[i].routes:
+                    routeSim = routeSims[getRouteSignature(route)]
+                    rewards[i, nRuns[i]:target[i]] += routeSim.reward * routeSim.ok[nRuns[i]:target[i]]
+                spent += target[i] - nRuns[i]
+                nRuns[i] = target[i]
+        means = np.array([rewards[i, :nRuns[i]].mean() for i in alive])
+        b = alive[int(np.argmax(means))]
+        # drop the sols whose paired difference with the best one is clearly positive
+        for i in alive[:]:
+            if i != b:
+                diffMean, diffSE = getPairedDiff(rewards, nRuns, b, i)
+                if diffMean - z * diffSE > 0:
+                    alive.remove(i)
+        if len(alive) == 1 or spent >= budget or np.all(nRuns[alive] >= nMax):
+            break
+        # OCBA ratios: N_i ~ (std_i / delta_i)^2 for i != b, N_b = std_b * sqrt(sum (N_i / std_i)^2)
+        means = np.array([rewards[i, :nRuns[i]].mean() for i in alive])
+        stds = np.maximum(np.array([rewards[i, :nRuns[i]].std(ddof=1) for i in alive]), 1e-9)
+        bPos = alive.index(b)
+        delta = np.maximum(means[bPos] - means, 1e-9)
+        ratios = (stds / delta)**2
+        ratios[bPos] = 0.0
+        ratios[bPos] = stds[bPos] * math.sqrt(((ratios / stds)**2).sum())
+        total = nRuns[alive].sum() + min(blockSize * len(alive), budget - spent)
+        newTarget = np.ceil(ratios / ratios.sum() * total).astype(int)
+        newTarget = np.minimum(np.maximum(newTarget, nRuns[alive]), nMax)
+        if np.all(newTarget == nRuns[alive]): # rounding: extend the sol furthest below its OCBA share
+            share = ratios / ratios.sum() * total # same units as newTarget (runs)
+            pos = int(np.argmax(np.where(nRuns[alive] < nMax, share - nRuns[alive], -np.inf)))
+            newTarget[pos] = min(nRuns[alive[pos]] + blockSize, nMax)
+        target[alive] = newTarget
+    for i, sol in enumerate(sols):
+        setRewardSim([sol], rewards[None, i, :nRuns[i]])
+    # probability of correct selection (Bonferroni lower bound over the paired differences)
+    confidence = 1.0
+    for i in range(len(sols)):
+        if i != b:
+            diffMean, diffSE = getPairedDiff(rewards, nRuns, b, i)
+            if diffSE > 0:
+                confidence -= 0.5 * math.erfc(diffMean / diffSE / math.sqrt(2))
+            elif diffMean <= 0:
+                confidence -= 0.5 # same rewards in all the common runs
+    sols[b].confidence = max(confidence, 0.0)
+    return sols[b]
+
+''' Mean and standard error of the differences in reward between sols b and i in their common runs '''
+def getPairedDiff(rewards, nRuns, b, i):
+    n = min(nRuns[b], nRuns[i])
+    diff = rewards[b, :n] - rewards[i, :n]
+    if n < 2:
+        return float(diff.mean()), 0.0
+    return float(diff.mean()), float(diff.std(ddof=1) / math.sqrt(n))
+
+''' Canonical signature of a route: its sequence of node IDs '''
+def getRouteSignature(route):
+    return tuple(e.end.ID for e in route.edges)
+
+''' Arrays describing the edges of some routes, one column per distinct edge '''
+def buildSimLayout(routes, varLevel, costModel=None):
+    layout = SimLayout()
+    if costModel is None:
+        for route in routes: # for experiments, set the type of each edge (det/stoch/dyn)
+            setRouteEdgesType(route)
+    columns = {} # (origin ID, end ID) -> column in a block of sampled edge costs
+    edges = []
+    edgeColumn = []
+    for route in routes:
+        for e in route.edges:
+            key = (e.origin.ID, e.end.ID)
+            if key not in columns:
+                columns[key] = len(edges)
+                edges.append(e)
+            edgeColumn.append(columns[key])
+    layout.keys = list(columns)
+    layout.edgeColumn = np.array(edgeColumn)
+    layout.cost, eType, mu, sigma, b_w, b_t = getEdgeParams(edges, varLevel, costModel)
+    layout.stoch = np.flatnonzero(eType == 1) # edges with a stochastic travel time
+    layout.dyn = np.flatnonzero(eType == 2) # edges with a dynamic travel time
+    layout.mu, layout.sigma = mu[layout.stoch], sigma[layout.stoch]
+    layout.b_w, layout.b_t = b_w[layout.dyn], b_t[layout.dyn]
+    if costModel is not None and costModel.travelModel is not None:
+        layout.travelModel = costModel.travelModel
+        layout.dynKeys = [layout.keys[c] for c in layout.dyn]
+        layout.dynFeatures = getEdgeFeatures([edges[c] for c in layout.dyn], costModel)
+    layout.routeStarts = np.cumsum([0] + [len(route.edges) for route in routes[:-1]])
+    layout.routeRewards = np.array([sum(e.end.reward for e in route.edges) for route in routes])
+    return layout
+
+''' Samples the cost of each route in a block of runs, shape (len(weather), nRoutes) '''
+# without a scenario bank, traffic and lognormal values are drawn from rng (the global numpy
+# RNG if not given); with a bank, they are read from its runs first, ..., first + len(weather) - 1
+def sampleRouteCosts(layout, weather, bank=None, first=0, rng=None):
+    if rng is None:
+        rng = np.random
+    nBlock = len(weather)
+    edgeCosts = np.tile(layout.cost, (nBlock, 1))
+    if len(layout.stoch) > 0:
+        if bank is None:
+            edgeCosts[:, layout.stoch] = rng.lognormal(mean=layout.mu, sigma=layout.sigma,
+                size=(nBlock, len(layout.stoch)))
+        else:
+            normal = bank.getNormal([layout.keys[c] for c in layout.stoch], first, nBlock)
+            edgeCosts[:, layout.stoch] = np.exp(layout.mu + layout.sigma * normal)
+    if len(layout.dyn) > 0:
+        if bank is None:
+            traffic = rng.random((nBlock, len(layout.dyn))) # edge traffic adversity levels
+        else:
+            traffic = bank.getTraffic([layout.keys[c] for c in layout.dyn], first, nBlock)
+        if layout.travelModel is None:
+            edgeCosts[:, layout.dyn] = layout.cost[layout.dyn] + layout.b_w*weather[:, None] + layout.b_t*traffic
+        else: # one batch for the whole block
+            edgeCosts[:, layout.dyn] = layout.travelModel.getCosts(layout.dynKeys, layout.dynFeatures, weather, traffic)
+    return np.add.reduceat(edgeCosts[:, layout.edgeColumn], layout.routeStarts, axis=1)
+
+''' Independent streams of nBlocks blocks of runs: children of rng (see SeedSequence.spawn), so
+the values of a block do not depend on how many values other blocks draw. Without rng, all the
+blocks draw from the global numpy RNG '''
+def getBlockRNGs(rng, nBlocks):
+    if rng is None:
+        return [np.random] * nBlocks
+    return rng.spawn(nBlocks)
+
+''' Features of some edges for travel-time models: cost, (x, y) of the origin and (x, y) of the end '''
+def getEdgeFeatures(edges, costModel):
+    origins = [e.origin.ID for e in edges]
+    ends = [e.end.ID for e in edges]
+    cost = np.array([e.cost for e in edges], dtype=float)
+    return np.column_stack([cost, costModel.coords[origins], costModel.coords[ends]])
+
+''' Sets reward_sim in each sol from its rewards in each run '''
+def setRewardSim(sols, rewards):
+    for sol, solRewards in zip(sols, rewards):
+        sol.reward_sim = float(solRewards.mean()) if len(solRewards) > 0 else 0.0
+        sol.reward_se = float(solRewards.std(ddof=1) / math.sqrt(len(solRewards))) if len(solRewards) > 1 else 0.0
+        sol.nRuns_sim = len(solRewards)
+
+''' Lognormal parameters of costs with E[X] = mean and Var[X] = varLevel * mean '''
+def getLognormalParams(mean, varLevel):
+    var = varLevel * mean
+    mu = np.log(mean**2 / np.sqrt(var + mean**2))
+    sigma = np.sqrt(np.log(1 + var / mean**2))
+    return mu, sigma
+
+''' Cost, type, lognormal params and dynamic coefs of some edges, as arrays read from the cost
+model or, without a model, computed from each edge (its type must have been set) '''
+def getEdgeParams(edges, varLevel, costModel=None):
+    cost = np.array([e.cost for e in edges], dtype=float)
+    if costModel is None:
+        eType = np.array([e.type for e in edges], dtype=int)
+        with np.errstate(divide="ignore", invalid="ignore"): # for null costs
+            mu, sigma = getLognormalParams(cost, varLevel)
+        b_w = 0.2 * cost * 0.25 # coefficient for weather conditions, see getDynamicValue
+        b_t = 0.3 * cost * 0.25 # coefficient for traffic conditions
+        return cost, eType, mu, sigma, b_w, b_t
+    origins = [e.origin.ID for e in edges]
+    ends = [e.end.ID for e in edges]
+    return (cost, costModel.type[origins, ends], costModel.mu[origins, ends], costModel.sigma[origins, ends],
+        costModel.b_w[origins, ends], costModel.b_t[origins, ends])
 
 ''' Generates a random cost from a lognormal distribution '''
 def getStochasticValue(mean=None, varLevel=None, scale=None, location=None):
@@ -102,3 +447,229 @@ def getDynamicValue(edge, weather, traffic):
 
 
 
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+    IMPORTANCE SAMPLING OF ROUTE FAILURES (RARE ROUTE-LIMIT VIOLATIONS)
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# The failure prob. of each route is estimated on its own, sampling its costs from a tilted
+# distribution that makes failures frequent, and reweighting each run by its likelihood ratio.
+# Uniform weather / traffic levels u with coefficient b in the route cost get the density
+# exp(lam*b*u) (exponential tilting), and lognormal costs c*exp(sigma*z) get z ~ N(lam*c*sigma, 1),
+# with lam such that the expected route cost under the tilted distribution is routeMaxCost.
+# The sol reward is the sum of route rewards times their success probs (routes are independent)
+MAX_TILT = 500.0 # max tilting parameter of a uniform level
+
+''' Sets reward_sim and its standard error reward_se in each sol, using nRuns IS runs per route '''
+def importanceSimulation(sols, nRuns, routeMaxCost, varLevel, costModel=None, rng=None):
+    for sol in sols:
+        reward, var = 0.0, 0.0
+        for route, routeRNG in zip(sol.routes, getBlockRNGs(rng, len(sol.routes))): # a stream per route
+            failProb, failSE = getRouteFailProbIS(route, nRuns, routeMaxCost, varLevel, costModel, routeRNG)
+            routeReward = sum(e.end.reward for e in route.edges)
+            reward += routeReward * (1 - failProb)
+            var += (routeReward * failSE)**2
+        sol.reward_sim = reward
+        sol.reward_se = math.sqrt(var)
+        sol.nRuns_sim = nRuns
+
+''' IS estimate of the prob. that the cost of a route exceeds routeMaxCost, and its standard error '''
+def getRouteFailProbIS(route, nRuns, routeMaxCost, varLevel, costModel=None, rng=None):
+    checkLinearCosts(costModel)
+    if rng is None:
+        rng = np.random
+    if costModel is None:
+        setRouteEdgesType(route) # for experiments, set the type of each edge (det/stoch/dyn)
+    cost, eType, mu, sigma, b_w, b_t = getEdgeParams(route.edges, varLevel, costModel)
+    dyn = eType == 2
+    stochCost = cost[eType == 1]
+    mu, sigma = mu[eType == 1], sigma[eType == 1]
+    fixed = cost[eType != 1].sum()
+    # coefficients of the weather level and of the traffic level of each dynamic edge
+    coefs = np.concatenate(([b_w[dyn].sum()], b_t[dyn])) if dyn.any() else np.zeros(0)
+    lam = getTiltParam(fixed, coefs, stochCost, mu, sigma, routeMaxCost)
+    theta = np.minimum(lam * coefs, MAX_TILT)
+    delta = lam * stochCost * sigma
+    u = getTiltedUniforms(rng.random((nRuns, len(coefs))), theta)
+    z = rng.standard_normal((nRuns, len(stochCost))) + delta
+    routeCost = fixed + u @ coefs + np.exp(mu + sigma * z).sum(axis=1)
+    logLR = (np.log(getTiltNorm(theta)) - theta * u).sum(axis=1) + (delta**2 / 2 - delta * z).sum(axis=1)
+    samples = (routeCost > routeMaxCost) * np.exp(logLR)
+    if nRuns < 2:
+        return float(samples.mean()), 0.0
+    return float(samples.mean()), float(samples.std(ddof=1) / math.sqrt(nRuns))
+
+''' Tilting parameter lam >= 0 such that the expected tilted route cost is routeMaxCost '''
+def getTiltParam(fixed, coefs, stochCost, mu, sigma, routeMaxCost):
+    def tiltedMean(lam):
+        theta = np.minimum(lam * coefs, MAX_TILT)
+        return fixed + coefs @ getTiltedMean(theta) + np.exp(mu + sigma * lam * stochCost * sigma + sigma**2 / 2).sum()
+    if tiltedMean(0.0) >= routeMaxCost or len(coefs) + len(stochCost) == 0:
+        return 0.0 # failures are not rare (or there is nothing random in the route)
+    low, high = 0.0, 1.0
+    while tiltedMean(high) < routeMaxCost and high < 1e6:
+        low, high = high, 2 * high
+    for i in range(50): # bisection
+        lam = (low + high) / 2
+        if tiltedMean(lam) < routeMaxCost:
+            low = lam
+        else:
+            high = lam
+    return high
+
+''' Inverse CDF of uniform levels in (0, 1) with density proportional to exp(theta * u) '''
+def getTiltedUniforms(v, theta):
+    safe = np.maximum(theta, 1e-12)
+    return np.where(theta > 1e-12, np.log1p(v * np.expm1(safe)) / safe, v)
+
+''' Normalizing constant of the tilted density, (exp(theta) - 1) / theta '''
+def getTiltNorm(theta):
+    safe = np.maximum(theta, 1e-12)
+    return np.where(theta > 1e-12, np.expm1(safe) / safe, 1.0)
+
+''' Mean of the tilted uniform levels '''
+def getTiltedMean(theta):
+    safe = np.maximum(theta, 1e-12)
+    return np.where(theta > 1e-12, 1 / -np.expm1(-safe) - 1 / safe, 0.5)
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+    ANALYTIC APPROXIMATION OF ROUTE FAILURES (PRE-SCREEN BEFORE SIMULATION)
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# Route cost = det costs + dynamic costs (linear in the weather w and in the traffic of each
+# edge, see getDynamicValue) + stochastic costs (lognormal). Given w, the traffic part is
+# approximated by a normal variable and the lognormal sum by a lognormal one with the same
+# mean and variance (Fenton-Wilkinson); P(route cost <= routeMaxCost) is then integrated
+# over the uniform weather (Gauss-Legendre) and over the traffic part (Gauss-Hermite)
+WEATHER_NODES, WEATHER_WEIGHTS = np.polynomial.legendre.leggauss(32)
+WEATHER_NODES, WEATHER_WEIGHTS = (WEATHER_NODES + 1) / 2, WEATHER_WEIGHTS / 2 # on (0, 1)
+TRAFFIC_NODES, TRAFFIC_WEIGHTS = np.polynomial.hermite_e.hermegauss(16)
+TRAFFIC_WEIGHTS = TRAFFIC_WEIGHTS / TRAFFIC_WEIGHTS.sum() # standard normal
+
+''' Sets reward_approx in each sol: expected reward given the approx. failure prob. of each route '''
+def approxSimulation(sols, routeMaxCost, varLevel, costModel=None):
+    for sol in sols:
+        sol.reward_approx = sum(route.reward * getRouteOkProb(route, routeMaxCost, varLevel, costModel)
+            for route in sol.routes)
+
+''' Approximate probability that the cost of a route does not exceed routeMaxCost '''
+def getRouteOkProb(route, routeMaxCost, varLevel, costModel=None):
+    checkLinearCosts(costModel)
+    if costModel is None:
+        setRouteEdgesType(route) # for experiments, set the type of each edge (det/stoch/dyn)
+    cost, eType, mu, sigma, b_w, b_t = getEdgeParams(route.edges, varLevel, costModel)
+    stoch = eType == 1
+    stochCost = cost[stoch]
+    # slack left by det costs and the weather part of dynamic costs, for each weather node
+    slack = routeMaxCost - cost[~stoch].sum() - b_w[eType == 2].sum() * WEATHER_NODES
+    b_t = b_t[eType == 2] # traffic coefficient of each dynamic edge
+    trafficMean = 0.5 * b_t.sum()
+    trafficSD = math.sqrt((b_t**2).sum() / 12)
+    if len(stochCost) == 0:
+        if trafficSD == 0:
+            okProb = (slack >= 0).astype(float)
+        else:
+            okProb = getNormalCDF((slack - trafficMean) / trafficSD)
+    else:
+        mean = stochCost.sum()
+        var = (stochCost**2 * np.expm1(sigma[stoch]**2)).sum() # Var[X] = varLevel * E[X] in each edge
+        sigma2 = math.log(1 + var / mean**2) # lognormal sum with the same mean and variance
+        mu = math.log(mean) - sigma2 / 2
+        rest = slack[:, None] - trafficMean - trafficSD * TRAFFIC_NODES[None, :]
+        lnRest = np.log(np.maximum(rest, 1e-300))
+        okProb = np.where(rest > 0, getNormalCDF((lnRest - mu) / math.sqrt(sigma2)), 0.0) @ TRAFFIC_WEIGHTS
+    return float(np.clip(okProb @ WEATHER_WEIGHTS, 0.0, 1.0))
+
+''' Analytic approximations and IS rely on dynamic costs being linear in weather and traffic '''
+def checkLinearCosts(costModel):
+    if costModel is not None and costModel.travelModel is not None:
+        raise ValueError("Dynamic costs predicted by a travel-time model are not supported here")
+
+''' Standard normal CDF of an array '''
+def getNormalCDF(x):
+    return 0.5 * np.vectorize(math.erfc, otypes=[float])(-np.asarray(x) / math.sqrt(2))
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+    STRATIFIED / QUASI-MONTE CARLO SAMPLERS FOR THE SCENARIO BANK
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# A sampler fills one column of the scenario bank (one value per run) for a given dimension:
+# 0 = weather level, 1 = traffic level of an edge (both uniform in (0, 1)), and 2 = standard
+# normal value of a stochastic edge, obtained by inverse transform of a uniform column.
+# With vdc, only the weather column follows the (1-D, base 2) van der Corput sequence run by
+# run. Each edge column is a scrambled van der Corput set of values in a random order of the runs,
+# as in a Latin hypercube, not a further dimension of a multi-dimensional QMC sequence:
+# edge columns built from the same 1-D sequence would be strongly dependent on each other
+# (and on the weather), which increases the variance instead of reducing it. Every value is
+# uniform in (0, 1) (random scrambling / permutation), so estimators are unbiased
+
+''' Returns the function sample(rng, nRuns, dim) of a sampler, or None for pseudo-random values '''
+def getSampler(name):
+    if name == "random":
+        return None
+    if name not in ("lhs", "vdc"):
+        raise ValueError("Unknown sampler: " + str(name))
+    def sample(rng, nRuns, dim):
+        if name == "lhs":
+            u = getLatinHypercube(rng, nRuns)
+        else:
+            u = getScrambledVdC(rng, nRuns)
+            if dim > 0: # edge column: stratified values in random order
+                u = u[rng.permutation(nRuns)]
+        if dim == 2:
+            return getInverseNormal(u)
+        return u
+    return sample
+
+''' Latin hypercube column: one value in each of the nRuns strata of (0, 1), in random order '''
+# the runs are only stratified as a whole, so prefixes of the column (e.g. short sims or
+# races) are plain random samples; with vdc, prefixes of the weather column are also stratified
+def getLatinHypercube(rng, nRuns):
+    return (rng.permutation(nRuns) + rng.random(nRuns)) / nRuns
+
+''' Van der Corput sequence in the given base (radical inverse of 0, 1, ..., nRuns - 1) '''
+def getRadicalInverse(nRuns, base):
+    i = np.arange(nRuns)
+    u = np.zeros(nRuns)
+    f = 1.0 / base
+    while np.any(i > 0):
+        u += f * (i % base)
+        i //= base
+        f /= base
+    return u
+
+''' Van der Corput sequence in base 2 (points 0, 1, ..., nRuns - 1) with a nested uniform
+(Owen) scrambling '''
+# each of the first ceil(log2(nRuns)) bits is flipped at random depending on the previous
+# ones, and the remaining bits are random: every prefix of 2^k runs stays stratified
+def getScrambledVdC(rng, nRuns):
+    m = max(1, math.ceil(math.log2(nRuns)))
+    digits = np.round(getRadicalInverse(nRuns, 2) * 2**m).astype(np.int64) # m bits, first digit = MSB
+    bits = np.zeros(nRuns, dtype=np.int64)
+    for level in range(m):
+        prefix = digits >> (m - level) # previous digits of each run
+        flip = rng.integers(0, 2, size=2**level)[prefix]
+        bits = (bits << 1) | (((digits >> (m - 1 - level)) & 1) ^ flip)
+    return (bits + rng.random(nRuns)) / 2**m
+
+''' Inverse of the standard normal CDF (Acklam's rational approximation, rel. error < 1.2e-9) '''
+def getInverseNormal(u):
+    a = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+        1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00)
+    b = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+        6.680131188771972e+01, -1.328068155288572e+01)
+    c = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+        -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00)
+    d = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+        3.754408661907416e+00)
+    u = np.asarray(u, dtype=float)
+    z = np.empty_like(u)
+    low = u < 0.02425 # lower tail
+    high = u > 1 - 0.02425 # upper tail
+    mid = ~(low | high)
+    q = u[mid] - 0.5
+    r = q * q
+    z[mid] = (((((a[0]*r + a[1])*r + a[2])*r + a[3])*r + a[4])*r + a[5]) * q / \
+        (((((b[0]*r + b[1])*r + b[2])*r + b[3])*r + b[4])*r + 1)
+    for tail, sign, p in ((low, 1, u[low]), (high, -1, 1 - u[high])):
+        q = np.sqrt(-2 * np.log(p))
+        z[tail] = sign * (((((c[0]*q + c[1])*q + c[2])*q + c[3])*q + c[4])*q + c[5]) / \
+            ((((d[0]*q + d[1])*q + d[2])*q + d[3])*q + 1)
+    return z
@@ -0,0 +1,68 @@
+''' Online surrogate of the simulated reward of a sol (the "learn" part of the learnheuristic) '''
+
+import math
+import numpy as np
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+    BAYESIAN LINEAR SURROGATE OF REWARD_SIM, TRAINED ONLINE
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# reward_sim is predicted as sum over routes of reward_r * (phi_r . w), i.e. the weights
+# w model the success prob. of a route from its features phi_r: 1, relative slack
+# s = (routeMaxCost - route cost) / routeMaxCost, s^2, share of dynamic and of stochastic
+# edges, and whether all the edges are det. The weights are fitted by recursive least
+# squares (Bayesian linear regression with a Gaussian prior) on the sols simulated so far
+ROUTE_FEATURES = ("one", "slack", "slack2", "dynShare", "stochShare", "detOnly")
+
+''' A class defining RewardSurrogate objects '''
+class RewardSurrogate:
+
+    def __init__(self, routeMaxCost, costModel, z = 2.0, minSamples = 12, priorPrecision = 1.0):
+        self.routeMaxCost = routeMaxCost
+        self.costModel = costModel # type of each edge
+        self.z = z # predicted upper bound = mean + z * standard deviation
+        self.minSamples = minSamples # no prediction is trusted before this number of samples
+        nFeatures = len(ROUTE_FEATURES)
+        self.P = np.eye(nFeatures) / priorPrecision # (X'X + priorPrecision * I)^-1
+        self.w = np.zeros(nFeatures) # posterior mean of the weights
+        self.sse = 0.0 # sum of squared standardized prediction errors
+        self.nSamples = 0
+        self.nSkipped = 0 # sols not simulated thanks to the surrogate
+
+    def getFeatures(self, sol): # reward-weighted sum of the features of each route
+        x = np.zeros(len(ROUTE_FEATURES))
+        for route in sol.routes:
+            edges = route.edges
+            eType = self.costModel.type[[e.origin.ID for e in edges], [e.end.ID for e in edges]]
+            slack = (self.routeMaxCost - route.cost) / self.routeMaxCost
+            dynShare = np.mean(eType == 2) if len(edges) > 0 else 0.0
+            stochShare = np.mean(eType == 1) if len(edges) > 0 else 0.0
+            phi = [1.0, slack, slack**2, dynShare, stochShare, float(dynShare + stochShare == 0)]
+            x += route.reward * np.array(phi)
+        return x
+
+    def predict(self, sol): # mean and standard deviation of the predicted reward_sim
+        x = self.getFeatures(sol)
+        var = self.getNoiseVar() * (1 + x @ self.P @ x)
+        return float(x @ self.w), math.sqrt(var)
+
+    def getNoiseVar(self):
+        return self.sse / self.nSamples if self.nSamples > 0 else 0.0
+
+    def update(self, sol): # learns from a simulated sol (Sherman-Morrison update)
+        x = self.getFeatures(sol)
+        Px = self.P @ x
+        denominator = 1 + x @ Px
+        error = sol.reward_sim - x @ self.w
+        self.sse += error**2 / denominator # prediction error standardized by its variance factor
+        self.nSamples += 1
+        self.P -= np.outer(Px, Px) / denominator
+        self.w += self.P @ x * error
+
+    def isUnpromising(self, sol, rival): # the predicted upper bound is below the rival reward_sim
+        if self.nSamples < self.minSamples:
+            return False
+        mean, sd = self.predict(sol)
+        if mean + self.z * sd < rival.reward_sim:
+            self.nSkipped += 1
+            return True
+        return False
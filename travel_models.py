@@ -0,0 +1,130 @@
+''' Travel-time models for dynamic edges (the "learn" part of the learnheuristic) '''
+
+import pickle
+import numpy as np
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+    TRAVEL-TIME MODELS EVALUATED IN BATCHES
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+# A model predicts the ratio between the dynamic cost of an edge and its standard cost from
+# a row of features, one row per (run, edge) of a simulation block. Models are fitted offline
+# and loaded from local files (see loadTravelModel)
+FEATURES = ("weather", "traffic", "cost", "originX", "originY", "endX", "endY")
+
+''' A class defining TravelModel objects (base class of the travel-time models) '''
+class TravelModel:
+
+    def predict(self, X): # cost ratio of each row of X, shape (nRows,)
+        raise NotImplementedError
+
+    # dynamic costs of some edges (keys = (origin ID, end ID), edgeFeatures = cost, originX,
+    # originY, endX, endY of each edge) in a block of runs, shape (len(weather), len(keys))
+    def getCosts(self, keys, edgeFeatures, weather, traffic):
+        return edgeFeatures[:, 0] * self.getRatios(edgeFeatures, weather, traffic)
+
+    def getRatios(self, edgeFeatures, weather, traffic): # one batch for the whole block
+        nBlock, nEdges = traffic.shape
+        X = np.empty((nBlock, nEdges, len(FEATURES)))
+        X[:, :, 0] = weather[:, None]
+        X[:, :, 1] = traffic
+        X[:, :, 2:] = edgeFeatures[None, :, :]
+        return self.predict(X.reshape(-1, len(FEATURES))).reshape(nBlock, nEdges)
+
+''' A class defining LinearTravelModel objects (linear regression on the features) '''
+class LinearTravelModel(TravelModel):
+
+    def __init__(self, coefs, intercept):
+        self.coefs = np.asarray(coefs, dtype = float) # one coef per feature
+        self.intercept = float(intercept)
+
+    def predict(self, X):
+        return X @ self.coefs + self.intercept
+
+    def save(self, fileName):
+        np.savez(fileName, coefs = self.coefs, intercept = self.intercept)
+
+''' A class defining MLPTravelModel objects (small multilayer perceptron with ReLU units) '''
+class MLPTravelModel(TravelModel):
+
+    def __init__(self, weights, biases):
+        self.weights = [np.asarray(W, dtype = float) for W in weights] # W0, W1, ... (nIn x nOut)
+        self.biases = [np.asarray(b, dtype = float) for b in biases]
+
+    def predict(self, X):
+        for W, b in zip(self.weights[:-1], self.biases[:-1]):
+            X = np.maximum(X @ W + b, 0.0)
+        return (X @ self.weights[-1] + self.biases[-1]).ravel()
+
+    def save(self, fileName):
+        layers = {}
+        for i, (W, b) in enumerate(zip(self.weights, self.biases)):
+            layers["W" + str(i)], layers["b" + str(i)] = W, b
+        np.savez(fileName, **layers)
+
+''' A class defining PickledTravelModel objects (any fitted model with a predict(X) method,
+e.g. a tree ensemble) '''
+class PickledTravelModel(TravelModel):
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, X):
+        return np.asarray(self.model.predict(X), dtype = float).ravel()
+
+''' A class defining BinnedTravelModel objects (prediction cache of another model) '''
+class BinnedTravelModel(TravelModel):
+    # Weather and traffic levels are discretized in nBins bins each, and the cost ratio of an
+    # edge is predicted once for the center of each (weather bin, traffic bin) pair: all the
+    # missing edges of a block are predicted in a single batch, and later blocks only read
+
+    def __init__(self, model, nBins = 16):
+        self.model = model
+        self.nBins = nBins
+        self.tables = {} # (origin ID, end ID) -> cost ratios, shape (nBins, nBins)
+
+    def predict(self, X): # no cache for rows without an edge key
+        return self.model.predict(X)
+
+    def getCosts(self, keys, edgeFeatures, weather, traffic):
+        missing = [i for i, key in enumerate(keys) if key not in self.tables]
+        if len(missing) > 0:
+            centers = (np.arange(self.nBins) + 0.5) / self.nBins
+            # one block of runs per (weather, traffic) center, for all the missing edges
+            weatherGrid = np.repeat(centers, self.nBins)
+            trafficGrid = np.tile(centers, self.nBins)[:, None].repeat(len(missing), axis = 1)
+            ratios = self.model.getRatios(edgeFeatures[missing], weatherGrid, trafficGrid)
+            for j, i in enumerate(missing):
+                self.tables[keys[i]] = ratios[:, j].reshape(self.nBins, self.nBins)
+        tables = np.stack([self.tables[key] for key in keys]) # shape (nEdges, nBins, nBins)
+        weatherBin = np.minimum((weather * self.nBins).astype(int), self.nBins - 1)
+        trafficBin = np.minimum((traffic * self.nBins).astype(int), self.nBins - 1)
+        ratio = tables[np.arange(len(keys))[None, :], weatherBin[:, None], trafficBin]
+        return edgeFeatures[:, 0] * ratio
+
+''' The built-in regression of getDynamicValue as a linear model (e.g., to save it as a template) '''
+def getDefaultTravelModel():
+    # cost * (1 + 0.2 * 0.25 * weather + 0.3 * 0.25 * traffic)
+    return LinearTravelModel([0.2 * 0.25, 0.3 * 0.25, 0, 0, 0, 0, 0], 1.0)
+
+''' Loads a fitted model from a local file: .npz (linear or MLP layers) or .pkl (pickled model) '''
+def loadTravelModel(fileName, nBins = 0):
+    if fileName.endswith(".npz"):
+        data = np.load(fileName)
+        if "coefs" in data:
+            model = LinearTravelModel(data["coefs"], data["intercept"])
+        elif "W0" in data:
+            nLayers = len([name for name in data.files if name.startswith("W")])
+            model = MLPTravelModel([data["W" + str(i)] for i in range(nLayers)],
+                [data["b" + str(i)] for i in range(nLayers)])
+        else:
+            raise ValueError("Unknown travel-time model in " + fileName)
+    elif fileName.endswith(".pkl") or fileName.endswith(".pickle"):
+        with open(fileName, "rb") as file:
+            model = pickle.load(file)
+        if not isinstance(model, TravelModel):
+            model = PickledTravelModel(model)
+    else:
+        raise ValueError("Unknown travel-time model file: " + fileName)
+    if nBins > 0:
+        model = BinnedTravelModel(model, nBins)
+    return model